@@ -0,0 +1,265 @@
+"""
+SiliconLife Eyeflow
+Content-addressed local store for downloaded models and packs
+
+Files are kept once under <blob_store>/<hash_type>/<xx>/<hexdigest> and hardlinked (or reflinked/copied
+when a hardlink is not possible) to the paths where they are used. The link count of a blob is its
+refcount. An index file maps the artifact keys (dataset/pack) and versions to the blobs, and the
+hashes given by the server (md5/sha1) to the sha256 of the blob.
+The store is host level (/opt/eyeflow/blobs, bound into the endpoint containers) so a model or pack
+is downloaded once per host. Archives are kept in the store and extracted from the blob.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from eyeflow_sdk.log_obj import CONFIG, log
+
+BLOB_FOLDER = CONFIG["file-service"].get("blob_store", os.path.join(os.path.dirname(CONFIG["file-service"]["data_folder"]), "blobs"))
+INDEX_FILE = os.path.join(BLOB_FOLDER, "index.json")
+HASH_TYPE = "sha256"
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+
+ALIAS_PREFIX = "alias:"
+
+_index_lock = threading.Lock()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def set_blob_folder(folder):
+    """
+    Use another store folder than the one of CONFIG (endpoint_agent shares the host store with the containers)
+    """
+    global BLOB_FOLDER, INDEX_FILE
+    BLOB_FOLDER = folder
+    INDEX_FILE = os.path.join(BLOB_FOLDER, "index.json")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+@contextmanager
+def index_lock():
+    """
+    Lock the index between threads and processes (cloud_sync and upgrade_edge can run at the same time)
+    """
+    os.makedirs(BLOB_FOLDER, exist_ok=True)
+    with _index_lock:
+        with open(INDEX_FILE + ".lock", 'w') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_index():
+    if not os.path.isfile(INDEX_FILE):
+        return {}
+
+    try:
+        with open(INDEX_FILE) as fp:
+            return json.load(fp)
+    except Exception as excp:
+        log.warning(f"Fail reading blob index {INDEX_FILE} - {excp}")
+        return {}
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def save_index(index):
+    tmp_file = INDEX_FILE + ".tmp"
+    with open(tmp_file, 'w') as fp:
+        json.dump(index, fp, indent=2)
+
+    os.replace(tmp_file, INDEX_FILE)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_blob_path(file_hash):
+    hash_type, hash_value = file_hash.split(":", 1)
+    hash_value = hash_value.lower()
+    return os.path.join(BLOB_FOLDER, hash_type, hash_value[:2], hash_value)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def has_blob(file_hash):
+    return file_hash is not None and os.path.isfile(get_blob_path(file_hash))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def resolve(file_hash):
+    """
+    Return the hash of the blob with the bytes of file_hash ('sha256:...' or an alias as 'md5:...'), or None
+    """
+    if file_hash is None:
+        return None
+
+    if file_hash.split(":", 1)[0] != HASH_TYPE:
+        with index_lock():
+            entry = load_index().get(ALIAS_PREFIX + file_hash.lower())
+
+        if entry is None:
+            return None
+
+        file_hash = entry["hash"]
+
+    return file_hash if has_blob(file_hash) else None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def find(key, version, file_hash=None):
+    """
+    Return the hash of the blob stored for key/version or with the bytes of file_hash, or None
+    """
+    return lookup(key, version) or resolve(file_hash)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_refcount(file_hash):
+    """
+    Number of paths using the blob, besides the store itself
+    """
+    blob_path = get_blob_path(file_hash)
+    if not os.path.isfile(blob_path):
+        return 0
+
+    return os.stat(blob_path).st_nlink - 1
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def lookup(key, version):
+    """
+    Return the hash of the blob stored for key/version, or None
+    """
+    with index_lock():
+        entry = load_index().get(key)
+
+    if entry is None or entry["version"] != str(version) or not has_blob(entry["hash"]):
+        return None
+
+    return entry["hash"]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def hash_file(filename, hash_type=HASH_TYPE):
+    hasher = hashlib.new(hash_type)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+    return f"{hash_type}:{hasher.hexdigest()}"
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def link_file(src_filename, dest_filename):
+    """
+    Make dest_filename point to the same bytes as src_filename: hardlink, reflink or copy, in this order
+    """
+    os.makedirs(os.path.dirname(dest_filename), exist_ok=True)
+    tmp_filename = f"{dest_filename}.link-{os.getpid()}-{threading.get_ident()}"
+    if os.path.lexists(tmp_filename):
+        os.remove(tmp_filename)
+
+    try:
+        os.link(src_filename, tmp_filename)
+    except OSError:
+        try:
+            with open(src_filename, 'rb') as src_fp, open(tmp_filename, 'wb') as dest_fp:
+                fcntl.ioctl(dest_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            shutil.copyfile(src_filename, tmp_filename)
+
+    os.replace(tmp_filename, dest_filename)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def link_blob(file_hash, dest_filename):
+    """
+    Put the blob at dest_filename. Returns False if the blob is not in the store
+    """
+    blob_path = get_blob_path(file_hash)
+    if not os.path.isfile(blob_path):
+        return False
+
+    link_file(blob_path, dest_filename)
+    return True
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def add_file(filename, key=None, version=None, file_hash=None):
+    """
+    Add a downloaded file to the store and record it in the index under key/version.
+    A file_hash of another type than sha256 (the server md5/sha1) is recorded as an alias of the blob.
+    If the same bytes are already stored, filename is replaced by a link to the existing blob.
+    Returns the sha256 file hash.
+    """
+    alias = None
+    if file_hash is None or file_hash.split(":", 1)[0] != HASH_TYPE:
+        alias = file_hash
+        file_hash = hash_file(filename)
+
+    blob_path = get_blob_path(file_hash)
+    with index_lock():
+        if os.path.isfile(blob_path):
+            if not os.path.samefile(blob_path, filename):
+                link_file(blob_path, filename)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            link_file(filename, blob_path)
+
+        if key is not None or alias is not None:
+            index = load_index()
+            if key is not None:
+                index[key] = {
+                    "version": str(version),
+                    "hash": file_hash,
+                    "size": os.path.getsize(blob_path)
+                }
+
+            if alias is not None:
+                index[ALIAS_PREFIX + alias.lower()] = {"hash": file_hash}
+
+            save_index(index)
+
+    return file_hash
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def gc():
+    """
+    Remove the blobs that are not in the index and not linked anywhere else, and the aliases of removed blobs.
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    with index_lock():
+        index = load_index()
+        # an alias alone does not keep a blob
+        indexed = set(get_blob_path(entry["hash"]) for key, entry in index.items() if not key.startswith(ALIAS_PREFIX))
+        for root, dirs, files in os.walk(BLOB_FOLDER):
+            if root == BLOB_FOLDER:
+                continue
+
+            for filename in files:
+                blob_path = os.path.join(root, filename)
+                blob_stat = os.stat(blob_path)
+                if blob_path not in indexed and blob_stat.st_nlink == 1:
+                    os.remove(blob_path)
+                    freed += blob_stat.st_size
+
+        missing = [key for key in index if not os.path.isfile(get_blob_path(index[key]["hash"]))]
+        if missing:
+            for key in missing:
+                index.pop(key)
+
+            save_index(index)
+
+    if freed:
+        log.info(f"Blob store: {freed} bytes freed")
+
+    return freed
+#----------------------------------------------------------------------------------------------------------------------------------
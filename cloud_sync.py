@@ -9,21 +9,29 @@ Author: Alex Sobral de Freitas
 
 import os
 import traceback
+import asyncio
 import json
 import requests
 import jwt
-import subprocess
 import datetime
-import tarfile
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # from bson import ObjectId
 from eyeflow_sdk import edge_client
 from eyeflow_sdk.log_obj import CONFIG, log
 
-proxies = {}
-if "proxies" in CONFIG:
-    proxies = CONFIG["proxies"]
-
 import utils
+import http_client
+import metrics
+
+tasks_conf = CONFIG.get("tasks", {})
+
+TASKS = metrics.counter("eyeflow_tasks_total", "Edge tasks executed, by type and result", ["type", "result"])
+TASK_SECONDS = metrics.histogram("eyeflow_task_seconds", "Duration of the edge tasks", ["type"])
+SYNC_STAGE_SECONDS = metrics.gauge("eyeflow_sync_stage_seconds", "Duration of the cloud sync stages in the last run", ["stage"])
+SYNC_SECONDS = metrics.gauge("eyeflow_sync_seconds", "Duration of the last cloud sync")
+SYNC_SUCCESS = metrics.gauge("eyeflow_sync_last_success_timestamp_seconds", "Time of the last successful cloud sync")
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -31,26 +39,11 @@ def upload_file(app_token, task_id, filename):
     log.info(f'Uploading file: {filename} - task: {task_id}')
 
     try:
-        tar_filename = f"{filename}-{task_id}.tar.gz"
-        if os.path.isfile(tar_filename):
-            os.remove(tar_filename)
-
-        wd = os.getcwd()
-        os.chdir(os.path.dirname(filename))
-        with tarfile.open(tar_filename, "w:gz") as tar:
-            tar.add(os.path.basename(filename))
-
-        os.chdir(wd)
-
         endpoint = jwt.decode(app_token, options={"verify_signature": False})['endpoint']
         msg_headers = {'Authorization' : f'Bearer {app_token}'}
         url = f"{endpoint}/task/{task_id}/upload"
         print(url)
 
-        files = {
-            'file': open(tar_filename, 'rb')
-        }
-
         values = {
             "status": "completed",
             "task_result": json.dumps({
@@ -62,9 +55,14 @@ def upload_file(app_token, task_id, filename):
             }, default=str)
         }
 
-        response = requests.post(url, files=files, data=values, headers=msg_headers, proxies=proxies)
-
-        os.remove(tar_filename)
+        response = utils.post_tar_gz(
+            url,
+            files=[(filename, os.path.basename(filename))],
+            file_field="file",
+            filename=f"{os.path.basename(filename)}-{task_id}.tar.gz",
+            fields=values,
+            headers=msg_headers
+        )
 
         if response.status_code != 201:
             raise Exception(f"Failing upload file. Response Json: {response.json()}")
@@ -107,7 +105,7 @@ def post_task_result(app_token, task_id, retcode, stdout, stderr):
             }
         }
 
-        response = requests.post(url, json=event, headers=msg_headers, proxies=proxies)
+        response = http_client.post(url, json=event, headers=msg_headers)
 
         if response.status_code != 201:
             raise Exception(f"Failing insert task result: {response.json()}")
@@ -126,29 +124,201 @@ def post_task_result(app_token, task_id, retcode, stdout, stderr):
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
+def execute_task(app_token, task):
+    task_type = task["task"]["type"]
+    timeout = tasks_conf.get("timeout", {}).get(task_type)
+    if task_type == "install_pack":
+        log.info(f'Install pack: {task["task"]["params"]["pack"]["name"]}')
+        pack_doc, pack_filename = utils.download_pack(
+            app_token,
+            task["task"]["params"]["pack"],
+            pack_folder=CONFIG["file-service"]["temp_folder"],
+            arch=utils.get_device_arch(),
+            os_version=utils.get_os_version(),
+            extract=True
+        )
+        if pack_doc is not None:
+            retcode, stdout, stderr = utils.install_pack(pack_doc, pack_filename, timeout=timeout)
+            post_task_result(app_token, task_id=task["_id"], retcode=retcode, stdout=stdout, stderr=stderr)
+    elif task_type == "run_command":
+        cmd = task["task"]["params"]["command"]
+        log.info(f'Run command: {cmd}')
+        retcode, stdout, stderr = utils.run_process(cmd, name=f'task-{task["_id"]}', timeout=timeout)
+        if retcode != 0:
+            log.error(f"Fail executing command: {stderr}")
+        else:
+            log.info(f"Command success: {stdout}")
+
+        post_task_result(app_token, task_id=task["_id"], retcode=retcode, stdout=stdout, stderr=stderr)
+    elif task_type == "upload_file":
+        filename = task["task"]["params"]["filename"]
+        log.info(f'Upload file: {filename}')
+        upload_file(app_token, task_id=task["_id"], filename=filename)
+    else:
+        log.warning(f"Unknown task type: {task_type}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
 def execute_tasks(app_token, edge_tasks):
+    """
+    Execute the edge tasks on a pool of CONFIG["tasks"]["workers"] threads,
+    limiting the tasks of each type running at the same time by CONFIG["tasks"]["concurrency"].
+    The tasks wait in a queue per type and are submitted only when their type has a free slot,
+    so the tasks of a saturated type do not hold the workers from the other types.
+    """
     # log.info(json.dumps(edge_tasks, indent=2))
-    for task in edge_tasks:
-        if task["task"]["type"] == "install_pack":
-            log.info(f'Install pack: {task["task"]["params"]["pack"]["name"]}')
-            pack_doc, pack_filename = utils.download_pack(app_token, task["task"]["params"]["pack"], pack_folder=CONFIG["file-service"]["temp_folder"])
-            if pack_doc is not None:
-                retcode, stdout, stderr = utils.install_pack(pack_doc, pack_filename)
-                post_task_result(app_token, task_id=task["_id"], retcode=retcode, stdout=stdout, stderr=stderr)
-        elif task["task"]["type"] == "run_command":
-            cmd = task["task"]["params"]["command"]
-            log.info(f'Run command: {cmd}')
-            ret = subprocess.run(cmd, capture_output=True, shell=True)
-            if ret.returncode != 0:
-                log.error(f"Fail executing command: {ret.stderr.decode()}")
-            else:
-                log.info(f"Command success: {ret.stdout.decode()}")
-
-            post_task_result(app_token, task_id=task["_id"], retcode=ret.returncode, stdout=ret.stdout.decode(), stderr=ret.stderr.decode())
-        elif task["task"]["type"] == "upload_file":
-            filename = task["task"]["params"]["filename"]
-            log.info(f'Upload file: {filename}')
-            upload_file(app_token, task_id=task["_id"], filename=filename)
+    type_limits = tasks_conf.get("concurrency", {})
+    workers = max(1, tasks_conf.get("workers", 4))
+
+    def run_task(task):
+        task_type = task["task"]["type"]
+        try:
+            with TASK_SECONDS.time(type=task_type):
+                execute_task(app_token, task)
+
+            TASKS.inc(type=task_type, result="done")
+        except Exception as excp:
+            TASKS.inc(type=task_type, result="fail")
+            log.error(f'Fail executing task {task["_id"]} - {excp}')
+            log.error(traceback.format_exc())
+
+    type_queues = {}
+    for order, task in enumerate(edge_tasks):
+        type_queues.setdefault(task["task"]["type"], collections.deque()).append((order, task))
+
+    running = collections.Counter()
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while type_queues or futures:
+            while len(futures) < workers:
+                # the oldest task of a type with a free slot
+                ready = [
+                    task_type for task_type, type_queue in type_queues.items()
+                    if running[task_type] < max(1, type_limits.get(task_type, workers))
+                ]
+                if not ready:
+                    break
+
+                task_type = min(ready, key=lambda task_type: type_queues[task_type][0][0])
+                order, task = type_queues[task_type].popleft()
+                if not type_queues[task_type]:
+                    type_queues.pop(task_type)
+
+                futures[executor.submit(run_task, task)] = task_type
+                running[task_type] += 1
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                running[futures.pop(future)] -= 1
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def update_models(app_token, flow_data):
+    start_time = time.time()
+    summary = utils.update_models(app_token, flow_data)
+
+    total_bytes = 0
+    for dataset_id, result in summary.items():
+        log.info(f'Model {dataset_id}: {result["status"]} - {result["bytes"]} bytes - {result["elapsed"]:.1f}s')
+        total_bytes += result["bytes"]
+
+    log.info(f"Models update: {len(summary)} datasets - {total_bytes} bytes - {time.time() - start_time:.1f}s")
+    return summary
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_edge_data(app_token):
+    edge_data_filename = os.path.join(CONFIG["file-service"]["data_folder"], "edge_data.json")
+    edge_data = utils.get_edge_data(app_token)
+    if not edge_data:
+        log.warning("Fail getting edge_data from cloud")
+        if not os.path.isfile(edge_data_filename):
+            log.error("Fail getting edge_data from local backup")
+            return None
+
+        with open(edge_data_filename, 'r') as fp:
+            edge_data = json.load(fp)
+    else:
+        with open(edge_data_filename, 'w') as fp:
+            json.dump(edge_data, fp, default=str)
+
+    return edge_data
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+async def run_stage(stage, stage_timing, semaphore, func, *args):
+    """
+    Run a blocking sync stage in a worker thread, inside the concurrency budget
+    """
+    async with semaphore:
+        start_time = time.time()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        finally:
+            stage_timing[stage] = time.time() - start_time
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+async def sync_flow(app_token, flow_id, stage_timing, semaphore):
+    flow_data = await run_stage("get_flow", stage_timing, semaphore, edge_client.get_flow, app_token, flow_id)
+    if not flow_data:
+        raise Exception("Fail getting flow from local backup. Need to connect to cloud.")
+
+    await run_stage("update_models", stage_timing, semaphore, update_models, app_token, flow_data)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+async def sync_edge(app_token):
+    """
+    Sync run: after edge_data, the edge tasks and the flow retrieval run as independent stages,
+    and the models update waits only for the flow.
+    Returns False when edge_data can not be loaded or any stage fails.
+    """
+    start_time = time.time()
+    stage_timing = {}
+    semaphore = asyncio.Semaphore(CONFIG.get("sync", {}).get("concurrency", 2))
+
+    edge_data = await run_stage("get_edge_data", stage_timing, semaphore, load_edge_data, app_token)
+    if not edge_data:
+        return False
+
+    stages = []
+    if "edge_data" in edge_data:
+        log.info(f'EyeflowEdge: {edge_data["edge_data"]["name"]} - {edge_data["edge_data"]["_id"]}')
+
+        if "edge_tasks" in edge_data:
+            stages.append(run_stage("execute_tasks", stage_timing, semaphore, execute_tasks, app_token, edge_data["edge_tasks"]))
+
+        if "flow_name" in edge_data["edge_data"]:
+            log.info(f'Active Flow: {edge_data["edge_data"]["flow_name"]} - {edge_data["edge_data"]["flow_id"]} - Last modified: {edge_data["edge_data"]["flow_modified_date"]}')
+            stages.append(sync_flow(app_token, edge_data["edge_data"]["flow_id"], stage_timing, semaphore))
+    elif "endpoint_data" in edge_data:
+        log.info(f'Endpoint: {edge_data["endpoint_data"]["_id"]}')
+        stages.append(sync_flow(app_token, edge_data["endpoint_data"]["flow_id"], stage_timing, semaphore))
+    elif "token_data" in edge_data and "endpoint_parms" in edge_data["token_data"]:
+        log.info(f'Endpoint: {edge_data["token_data"]["endpoint_id"]}')
+        stages.append(sync_flow(app_token, edge_data["token_data"]["endpoint_parms"]["flow_id"], stage_timing, semaphore))
+
+    results = await asyncio.gather(*stages, return_exceptions=True)
+
+    for stage, elapsed in stage_timing.items():
+        log.info(f"Sync stage {stage}: {elapsed:.1f}s")
+        SYNC_STAGE_SECONDS.set(elapsed, stage=stage)
+
+    log.info(f"Sync total: {time.time() - start_time:.1f}s")
+    SYNC_SECONDS.set(time.time() - start_time)
+
+    success = True
+    for result in results:
+        if isinstance(result, Exception):
+            log.error(f'Fail updating edge data {result}')
+            log.error("".join(traceback.format_exception(type(result), result, result.__traceback__)))
+            success = False
+
+    if success:
+        SYNC_SUCCESS.set_to_current_time()
+
+    return success
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -172,57 +342,16 @@ def main(args=None):
     utils.check_license(app_info)
 
     try:
-        edge_data_filename = os.path.join(CONFIG["file-service"]["data_folder"], "edge_data.json")
-        edge_data = utils.get_edge_data(app_token)
-        if not edge_data:
-            log.warning("Fail getting edge_data from cloud")
-            if not os.path.isfile(edge_data_filename):
-                log.error("Fail getting edge_data from local backup")
-                exit(1)
-
-            with open(edge_data_filename, 'r') as fp:
-                edge_data = json.load(fp)
-        else:
-            with open(edge_data_filename, 'w') as fp:
-                json.dump(edge_data, fp, default=str)
-
-        if "edge_data" in edge_data:
-            log.info(f'EyeflowEdge: {edge_data["edge_data"]["name"]} - {edge_data["edge_data"]["_id"]}')
-
-            if "edge_tasks" in edge_data:
-                execute_tasks(app_token, edge_data["edge_tasks"])
-
-            if "flow_name" in edge_data["edge_data"]:
-                log.info(f'Active Flow: {edge_data["edge_data"]["flow_name"]} - {edge_data["edge_data"]["flow_id"]} - Last modified: {edge_data["edge_data"]["flow_modified_date"]}')
-                flow_id = edge_data["edge_data"]["flow_id"]
-                flow_data = edge_client.get_flow(app_token, flow_id)
-                if not flow_data:
-                    log.error(f"Fail getting flow from local backup. Need to connect to cloud.")
-                    exit(1)
-
-                utils.update_models(app_token, flow_data)
-        elif "endpoint_data" in edge_data:
-            log.info(f'Endpoint: {edge_data["endpoint_data"]["_id"]}')
-            flow_id = edge_data["endpoint_data"]["flow_id"]
-            flow_data = edge_client.get_flow(app_token, flow_id)
-            if not flow_data:
-                log.error(f"Fail getting flow from local backup. Need to connect to cloud.")
-                exit(1)
-
-            utils.update_models(app_token, flow_data)
-        elif "token_data" in edge_data and "endpoint_parms" in edge_data["token_data"]:
-            log.info(f'Endpoint: {edge_data["token_data"]["endpoint_id"]}')
-            flow_id = edge_data["token_data"]["endpoint_parms"]["flow_id"]
-            flow_data = edge_client.get_flow(app_token, flow_id)
-            if not flow_data:
-                log.error(f"Fail getting flow from local backup. Need to connect to cloud.")
-                exit(1)
-
-            utils.update_models(app_token, flow_data)
+        success = asyncio.run(sync_edge(app_token))
+        http_client.log_stats()
+        metrics.write_textfile("cloud_sync")
+        if not success:
+            exit(1)
 
     except Exception as expt:
         log.error(f'Fail updating edge data {expt}')
         log.error(traceback.format_exc())
+        metrics.write_textfile("cloud_sync")
         exit(1)
 #----------------------------------------------------------------------------------------------------------------------------------
 
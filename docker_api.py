@@ -0,0 +1,352 @@
+"""
+SiliconLife Eyeflow
+Docker Engine API client over the Unix socket
+
+Each thread keeps its own kept-alive connection to the daemon. A container index (name -> state and
+host ports) is loaded once and then kept current from the /events stream, so state queries do not
+call the daemon.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import http.client
+from urllib.parse import urlencode, quote
+
+from eyeflow_sdk.log_obj import log
+
+DOCKER_SOCKET = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+API_VERSION = os.environ.get("DOCKER_API_VERSION", "v1.41")
+TIMEOUT = 60
+
+_local = threading.local()
+_index = {}
+_index_lock = threading.Lock()
+_event_callbacks = []
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API {status}: {message}")
+        self.status = status
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_connection():
+    if getattr(_local, "connection", None) is None:
+        _local.connection = UnixHTTPConnection(DOCKER_SOCKET)
+
+    return _local.connection
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def request(method, path, params=None, body=None, raw=False):
+    """
+    Send a request on the thread connection. Returns the decoded JSON (or None, or the body bytes with raw),
+    raises DockerError on an error status. A kept-alive connection closed by the daemon is reopened once,
+    resending the request only when it was not sent yet or is a GET: a POST may have been done by the daemon.
+    """
+    url = f"/{API_VERSION}{path}"
+    if params:
+        url += "?" + urlencode(params)
+
+    headers = {}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+
+    for attempt in range(2):
+        connection = get_connection()
+        sent = False
+        try:
+            connection.request(method, url, body=payload, headers=headers)
+            sent = True
+            response = connection.getresponse()
+            data = response.read()
+            break
+        except (http.client.HTTPException, ConnectionError, BrokenPipeError):
+            connection.close()
+            _local.connection = None
+            if attempt == 1 or (sent and method != "GET"):
+                raise
+
+    if response.status >= 400:
+        try:
+            message = json.loads(data).get("message", data.decode())
+        except Exception:
+            message = data.decode(errors="replace")
+
+        raise DockerError(response.status, message)
+
+    if raw:
+        return data
+
+    if data and response.getheader("Content-Type", "").startswith("application/json"):
+        return json.loads(data)
+
+    return None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def list_containers(all=False, filters=None):
+    params = {"all": "true" if all else "false"}
+    if filters:
+        params["filters"] = json.dumps(filters)
+
+    return request("GET", "/containers/json", params=params)
+
+
+def inspect_container(container):
+    return request("GET", f"/containers/{quote(container)}/json")
+
+
+def create_container(name, config):
+    return request("POST", "/containers/create", params={"name": name}, body=config)
+
+
+def start_container(container):
+    request("POST", f"/containers/{quote(container)}/start")
+
+
+def stop_container(container, timeout=10):
+    request("POST", f"/containers/{quote(container)}/stop", params={"t": timeout})
+
+
+def remove_container(container, force=False):
+    request("DELETE", f"/containers/{quote(container)}", params={"force": "true" if force else "false"})
+
+
+def rename_container(container, name):
+    request("POST", f"/containers/{quote(container)}/rename", params={"name": name})
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def parse_image(image):
+    """
+    'repo[:tag]' or 'repo@digest' -> (fromImage, tag) of an image pull
+    """
+    if "@" in image:
+        return image, ""
+
+    repo, sep, tag = image.rpartition(":")
+    if not sep or "/" in tag:
+        return image, "latest"
+
+    return repo, tag
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def pull_image(image):
+    """
+    Pull an image, like 'docker pull'. The daemon reports a failed pull in the progress stream, read to the end
+    """
+    from_image, tag = parse_image(image)
+    params = {"fromImage": from_image}
+    if tag:
+        params["tag"] = tag
+
+    data = request("POST", "/images/create", params=params, raw=True)
+    for line in data.splitlines():
+        try:
+            progress = json.loads(line)
+        except ValueError:
+            continue
+
+        if progress.get("error"):
+            raise DockerError(500, f"Fail pulling {image}: {progress['error']}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def run_container(name, config):
+    """
+    Create and start a container, like 'docker run --detach': the image is pulled when it is not on the host.
+    Returns the container id
+    """
+    try:
+        container_id = create_container(name, config)["Id"]
+    except DockerError as excp:
+        # 404 on create: no such image
+        if excp.status != 404:
+            raise
+
+        log.info(f"Pulling image {config['Image']} for {name}")
+        pull_image(config["Image"])
+        container_id = create_container(name, config)["Id"]
+
+    try:
+        start_container(container_id)
+    except DockerError:
+        remove_container(container_id, force=True)
+        raise
+
+    return container_id
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_host_ports(ports):
+    """
+    {'<port>/<proto>': host_port} from the Ports of a container list entry or NetworkSettings.Ports of an inspect
+    """
+    host_ports = {}
+    if isinstance(ports, list):
+        for port in ports:
+            if port.get("PublicPort"):
+                host_ports[f'{port["PrivatePort"]}/{port["Type"]}'] = port["PublicPort"]
+    elif isinstance(ports, dict):
+        for private_port, bindings in ports.items():
+            if bindings:
+                host_ports[private_port] = int(bindings[0]["HostPort"])
+
+    return host_ports
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def index_container(container_id):
+    """
+    Read the container from the daemon into the index. Returns the entry, or None if it does not exist
+    """
+    try:
+        data = inspect_container(container_id)
+    except DockerError as excp:
+        if excp.status == 404:
+            with _index_lock:
+                for name in [name for name, entry in _index.items() if entry["id"] == container_id]:
+                    _index.pop(name)
+
+            return None
+
+        raise
+
+    entry = {
+        "id": data["Id"],
+        "name": data["Name"].lstrip("/"),
+        "image": data["Config"]["Image"],
+        "state": data["State"]["Status"],
+        "ports": get_host_ports(data["NetworkSettings"].get("Ports") or {})
+    }
+    with _index_lock:
+        for name in [name for name, old_entry in _index.items() if old_entry["id"] == entry["id"]]:
+            _index.pop(name)
+
+        _index[entry["name"]] = entry
+
+    return entry
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def refresh_index():
+    index = {}
+    for data in list_containers(all=True):
+        name = data["Names"][0].lstrip("/")
+        index[name] = {
+            "id": data["Id"],
+            "name": name,
+            "image": data["Image"],
+            "state": data["State"],
+            "ports": get_host_ports(data.get("Ports", []))
+        }
+
+    with _index_lock:
+        _index.clear()
+        _index.update(index)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_container(name):
+    with _index_lock:
+        entry = _index.get(name)
+        return dict(entry) if entry is not None else None
+
+
+def get_containers(prefix="", state=None):
+    with _index_lock:
+        return [dict(entry) for name, entry in _index.items() if name.startswith(prefix) and (state is None or entry["state"] == state)]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def add_event_callback(callback):
+    """
+    callback(action, entry) is called from the event thread for the container events
+    """
+    _event_callbacks.append(callback)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def handle_event(event):
+    action = event.get("Action", event.get("status", ""))
+    container_id = event.get("id") or event.get("Actor", {}).get("ID")
+    if action in ["create", "start", "rename", "die", "stop", "pause", "unpause"]:
+        entry = index_container(container_id)
+    elif action == "destroy":
+        with _index_lock:
+            entry = None
+            for name in [name for name, old_entry in _index.items() if old_entry["id"] == container_id]:
+                entry = _index.pop(name)
+    else:
+        return
+
+    if entry is None:
+        name = event.get("Actor", {}).get("Attributes", {}).get("name", "")
+        entry = {"id": container_id, "name": name, "state": "removed", "ports": {}}
+
+    for callback in _event_callbacks:
+        try:
+            callback(action, entry)
+        except Exception as excp:
+            log.error(f"Fail handling docker event {action} {entry['name']} - {excp}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def watch_events():
+    """
+    Follow the /events stream of the containers. The index is refreshed on each (re)connection,
+    so no event is lost while disconnected.
+    """
+    while True:
+        connection = UnixHTTPConnection(DOCKER_SOCKET, timeout=None)
+        try:
+            params = {"filters": json.dumps({"type": ["container"]})}
+            connection.request("GET", f"/{API_VERSION}/events?" + urlencode(params))
+            response = connection.getresponse()
+            if response.status != 200:
+                raise DockerError(response.status, response.read().decode(errors="replace"))
+
+            refresh_index()
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+
+                line = line.strip()
+                if line:
+                    handle_event(json.loads(line))
+        except Exception as excp:
+            log.warning(f"Docker events stream closed - {excp}")
+        finally:
+            connection.close()
+
+        time.sleep(1)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def start_event_watcher():
+    refresh_index()
+    threading.Thread(target=watch_events, daemon=True).start()
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -13,8 +13,19 @@ import datetime
 import socket
 import pika
 import time
+import re
+import shutil
+import stat
+import fcntl
+import hashlib
+import uuid
+import threading
+import functools
+import collections
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import subprocess
-from subprocess import CalledProcessError
 import psutil
 from pathlib import Path
 import requests
@@ -26,6 +37,9 @@ from eyeflow_sdk.message_queue import publish_message
 from eyeflow_sdk.log_obj import log
 
 import eyeflow_sdk.nv_gpu as nv_gpu
+
+import metrics
+import docker_api
 #----------------------------------------------------------------------------------------------------------------------------------
 
 def update_endpoint(request_parms, body):
@@ -45,84 +59,282 @@ def update_endpoint(request_parms, body):
             "status": "fail",
             "message": f"Fail updating endpoint: {endpoint_update_url} - {response.text}"
         }
+#----------------------------------------------------------------------------------------------------------------------------------
 
 
-def get_host_info():
-    host_info = {}
+@contextmanager
+def timed_phase(phases, name):
+    """
+    Record the duration of a phase of the endpoint start in phases (when not None)
+    """
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if phases is not None:
+            phases[name] = round(phases.get(name, 0) + time.time() - start_time, 3)
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    cpu_freq = psutil.cpu_freq(percpu=False)
-    host_info["cpu_info"] = {
-        "cpu_percent": psutil.cpu_percent(interval=0.1),
-        "current_freq": cpu_freq.current if cpu_freq else 0,
-        "max_freq": cpu_freq.max if cpu_freq else 0
-    }
 
-    mem_data = psutil.virtual_memory()
-    host_info["memory_info"] = {
-        "total": mem_data.total,
-        "available": mem_data.available
-    }
+def set_read_only(path):
+    """
+    Remove the write permission of the files of a cache folder
+    """
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            filename = os.path.join(root, filename)
+            file_stat = os.lstat(filename)
+            if not stat.S_ISLNK(file_stat.st_mode):
+                os.chmod(filename, file_stat.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    host_info["disk_info"] = {
-        "mounts": []
-    }
 
+def clone_file(src_filename, dest_filename):
+    """
+    Reflink src_filename to dest_filename (copy-on-write, no data copied), copying when the filesystem cannot
+    """
     try:
-        disk_io = psutil.disk_io_counters(perdisk=False)
-        host_info["disk_info"]["io_read_count"] = disk_io.read_count
-        host_info["disk_info"]["io_write_count"] = disk_io.write_count
-        host_info["disk_info"]["io_read_bytes"] = disk_io.read_bytes
-        host_info["disk_info"]["io_write_bytes"] = disk_io.write_bytes
-    except:
-        pass
+        with open(src_filename, 'rb') as src_fp, open(dest_filename, 'wb') as dest_fp:
+            fcntl.ioctl(dest_fp.fileno(), FICLONE, src_fp.fileno())
+        shutil.copystat(src_filename, dest_filename)
+    except OSError:
+        shutil.copy2(src_filename, dest_filename)
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    for part in psutil.disk_partitions(all=False):
-        if 'cdrom' in part.mountpoint or part.fstype == '':
-            # skip cd-rom drives with no disk in it; they may raise
-            # ENOENT, pop-up a Windows GUI error for a non-ready
-            # partition or just hang.
-            continue
 
-        usage = psutil.disk_usage(part.mountpoint)
-        dsk = {
-            "device": part.device,
-            "total": usage.total,
-            "used": usage.used,
-            "free": usage.free,
-            "use": usage.percent,
-            "type": part.fstype,
-            "mount": part.mountpoint
-        }
+def link_tree(src_path, dest_path):
+    """
+    Populate dest_path with writable reflinks (or copies) of the files of src_path.
+    Not hardlinks: the run folder is bind-mounted read-write in a container running as root, where a pack
+    install writing a file in place would change the cache and every other endpoint.
+    """
+    for root, dirs, files in os.walk(src_path):
+        rel_root = os.path.relpath(root, src_path)
+        dest_root = os.path.join(dest_path, rel_root)
+        Path(dest_root).mkdir(parents=True, exist_ok=True)
+        for filename in files:
+            dest_filename = os.path.join(dest_root, filename)
+            if os.path.lexists(dest_filename):
+                os.remove(dest_filename)
+
+            src_filename = os.path.join(root, filename)
+            if os.path.islink(src_filename):
+                os.symlink(os.readlink(src_filename), dest_filename)
+                continue
+
+            clone_file(src_filename, dest_filename)
+            os.chmod(dest_filename, os.stat(dest_filename).st_mode | stat.S_IWUSR)
+#----------------------------------------------------------------------------------------------------------------------------------
 
-        host_info["disk_info"]["mounts"].append(dsk)
 
-    host_info["net_info"] = psutil.net_io_counters(pernic=True)
+def get_edge_install(phases=None):
+    """
+    Return the cache folder with the files of the latest edge_install release.
+    The release is downloaded again only when its ETag changes. The download runs without _cache_lock,
+    that is only held to read and replace the current release.
+    """
+    cache_path = os.path.join(CACHE_PATH, "edge_install")
+    current_file = os.path.join(cache_path, "current.json")
+    with _cache_lock:
+        Path(cache_path).mkdir(parents=True, exist_ok=True)
+        current = get_current_edge_install(current_file)
+
+    headers = {}
+    if current.get("etag"):
+        headers["If-None-Match"] = current["etag"]
+
+    # private names for the files of this download, other threads can be downloading the same release
+    download_id = uuid.uuid4().hex[:12]
+    tar_file_path = os.path.join(cache_path, f".{EDGE_INSTALL_FILE}.{download_id}.part")
+    tmp_path = os.path.join(cache_path, f".release.{download_id}.tmp")
+    try:
+        with timed_phase(phases, "install_download"):
+            try:
+                response = requests.get(EDGE_INSTALL_URL, params={"downloadformat": "tar.gz"}, headers=headers, stream=True, timeout=(10, 120))
+            except requests.RequestException as excp:
+                if current:
+                    log.warning(f"Fail checking edge install: {EDGE_INSTALL_URL} - {excp}. Using cached {current['etag']}")
+                    return current["path"]
+
+                raise
+
+            with response:
+                if response.status_code == 304:
+                    return current["path"]
+
+                if not response.ok:
+                    if current:
+                        log.warning(f"Fail downloading edge install: {EDGE_INSTALL_URL} - {response.status_code}. Using cached {current['etag']}")
+                        return current["path"]
+
+                    raise Exception(f"Fail downloading edge install: {EDGE_INSTALL_URL} - {response.text}")
+
+                hasher = hashlib.sha256()
+                with open(tar_file_path, mode="wb") as file:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        hasher.update(chunk)
+                        file.write(chunk)
+
+        etag = response.headers.get("ETag") or hasher.hexdigest()
+        with timed_phase(phases, "install_extract"):
+            with tarfile.open(tar_file_path, 'r') as tar:
+                for file_name in EDGE_INSTALL_FILE_LIST:
+                    try:
+                        tar.extract(member=file_name, path=tmp_path)
+                    except KeyError:
+                        raise Exception(f"Warning: File '{file_name}' not found in the tar archive {EDGE_INSTALL_FILE}.")
+
+            set_read_only(tmp_path)
+
+        with _cache_lock:
+            previous = get_current_edge_install(current_file)
+            if previous.get("etag") == etag:
+                # installed by another thread while this one was downloading
+                return previous["path"]
+
+            release_path = os.path.join(cache_path, re.sub(r'[^A-Za-z0-9_.-]', '', etag)[:64] or hasher.hexdigest())
+            if os.path.isdir(release_path):
+                shutil.rmtree(release_path)
+
+            os.rename(tmp_path, release_path)
+            with open(current_file + ".tmp", "w") as fp:
+                json.dump({"etag": etag, "path": release_path}, fp)
+
+            os.replace(current_file + ".tmp", current_file)
+            log.info(f"Edge install cached: {etag}")
+
+            # endpoints already started have their own copies of the old files
+            if previous and previous["path"] != release_path:
+                shutil.rmtree(previous["path"], ignore_errors=True)
+
+        return release_path
+    finally:
+        if os.path.isfile(tar_file_path):
+            os.remove(tar_file_path)
+
+        shutil.rmtree(tmp_path, ignore_errors=True)
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    host_info["temperature_info"] = []
-    temp_info = dict(psutil.sensors_temperatures())
-    for sensor in temp_info:
-        sensor_info = {
-            "sensor": sensor,
-            "info": []
-        }
 
-        for info in temp_info[sensor]:
-            sensor_info["info"].append({
-                "label": info.label,
-                "current": info.current,
-                "high": info.high,
-                "critical": info.critical
-            })
+def get_current_edge_install(current_file):
+    """
+    {"etag", "path"} of the cached edge_install release, or {} when there is none. Called with _cache_lock
+    """
+    if not os.path.isfile(current_file):
+        return {}
 
-        host_info["temperature_info"].append(sensor_info)
+    with open(current_file) as fp:
+        current = json.load(fp)
+
+    if not os.path.isdir(current.get("path", "")):
+        return {}
+
+    return current
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_cached_edge_pack():
+    """
+    Return the cache folder of the newest eyeflow_edge pack version, or None
+    """
+    cache_path = os.path.join(CACHE_PATH, "packs", "eyeflow_edge")
+    if not os.path.isdir(cache_path):
+        return None
+
+    cached = sorted(
+        [os.path.join(cache_path, version) for version in os.listdir(cache_path) if not version.startswith(".")],
+        key=os.path.getmtime
+    )
+    return cached[-1] if cached else None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_edge_pack(endpoint_token, edge_install_path, phases=None):
+    """
+    Return the cache folder of the eyeflow_edge pack, downloading the pack only when its version changes
+    """
+    if edge_install_path not in sys.path:
+        sys.path.append(edge_install_path)
+
+    import utils
+    utils.blob_store.set_blob_folder(BLOB_STORE_PATH)
 
-    host_info["host_date"] = datetime.datetime.now()
+    edge_pack = {
+        "name": "eyeflow_edge",
+        "id": "64fb7933f257ab6cb37ce65d",
+        "version": "latest"
+    }
 
-    return host_info
+    cache_path = os.path.join(CACHE_PATH, "packs", edge_pack["name"])
+    Path(cache_path).mkdir(parents=True, exist_ok=True)
+    arch = utils.get_device_arch()
+    os_version = utils.get_os_version()
+    pack_doc = utils.get_pack(endpoint_token, edge_pack, arch=arch, os_version=os_version)
+    if pack_doc is None:
+        cached = get_cached_edge_pack()
+        if cached:
+            log.warning(f"Fail getting pack {edge_pack['name']}. Using cached {cached}")
+            return cached
+
+        raise Exception(f"Fail getting pack {edge_pack['name']}")
+
+    version_path = os.path.join(cache_path, str(pack_doc["version"]))
+    if os.path.isdir(version_path):
+        return version_path
+
+    # the download runs without _cache_lock, in a folder of its own
+    tmp_path = os.path.join(cache_path, f".tmp-{uuid.uuid4().hex[:12]}")
+    try:
+        with timed_phase(phases, "pack_download"):
+            pack_doc, pack_folder = utils.download_pack(endpoint_token, edge_pack, pack_folder=tmp_path, arch=arch, os_version=os_version, extract=True)
+        if pack_folder is None:
+            raise Exception(f"Fail downloading pack {edge_pack['name']}")
+
+        set_read_only(pack_folder)
+        version_path = os.path.join(cache_path, str(pack_doc["version"]))
+        with _cache_lock:
+            if os.path.isdir(version_path):
+                return version_path
+
+            os.rename(pack_folder, version_path)
+            log.info(f"Pack {edge_pack['name']} cached: {pack_doc['version']}")
+
+            for version in os.listdir(cache_path):
+                if not version.startswith(".") and version != str(pack_doc["version"]):
+                    shutil.rmtree(os.path.join(cache_path, version), ignore_errors=True)
+
+        return version_path
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def endpoint_start(request_parms, port):
+def get_container_config(container_image, port, endpoint_base_path, env):
+    """
+    Engine API config of an endpoint container, as 'docker run --rm --gpus all --log-driver=journald'
+    """
+    return {
+        "Image": container_image,
+        "Env": [f"{name}={value}" for name, value in env.items()],
+        "ExposedPorts": {"8001/tcp": {}},
+        "HostConfig": {
+            "PortBindings": {"8001/tcp": [{"HostPort": str(port)}]},
+            "Binds": [
+                f"{os.path.join(endpoint_base_path, 'log')}:/opt/eyeflow/log",
+                f"{os.path.join(endpoint_base_path, 'data')}:/opt/eyeflow/data",
+                f"{os.path.join(endpoint_base_path, 'components')}:/opt/eyeflow/components",
+                f"{os.path.join(endpoint_base_path, 'run')}:/opt/eyeflow/run",
+                f"{BLOB_STORE_PATH}:/opt/eyeflow/blobs"
+            ],
+            "DeviceRequests": [{"Driver": "", "Count": -1, "Capabilities": [["gpu"]]}],
+            "LogConfig": {"Type": "journald", "Config": {}},
+            "AutoRemove": True
+        }
+    }
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def endpoint_start(request_parms, port, phases=None):
     endpoint_id = request_parms["endpoint_id"]
     endpoint_token = request_parms["endpoint_token"]
     pub_key = request_parms["pub_key"]
@@ -144,39 +356,11 @@ def endpoint_start(request_parms, port):
         Path(log_path).mkdir(parents=True, exist_ok=True)
         Path(components_path).mkdir(parents=True, exist_ok=True)
 
-        response = requests.get(EDGE_INSTALL_URL, params={"downloadformat": "tar.gz"})
-        if not response.ok:
-            log.error(f"Fail downloading edge install: {EDGE_INSTALL_URL} - {response.text}")
-            update_endpoint(request_parms, {
-                "status": "fail",
-                "logs": {
-                    "error": "endpoint_start_fail",
-                    "message": f"Fail executing endpoint: {endpoint_id}. Fail downloading edge install: {EDGE_INSTALL_URL} - {response.text}."
-                }
-            })
-
-        tar_file_path = os.path.join(endpoint_base_path, EDGE_INSTALL_FILE)
-        with open(tar_file_path, mode="wb") as file:
-            file.write(response.content)
-
         Path(run_path).mkdir(parents=True, exist_ok=True)
 
-        file_list = [
-            "eyeflow_conf.json",
-            "run_endpoint.sh",
-            "cloud_sync.py",
-            "upgrade_edge",
-            "upload_extracts.py",
-            "utils.py"
-        ]
-        with tarfile.open(tar_file_path, 'r') as tar:
-            for file_name in file_list:
-                try:
-                    tar.extract(member=file_name, path=run_path)
-                except KeyError:
-                    raise Exception(f"Warning: File '{file_name}' not found in the tar archive {EDGE_INSTALL_FILE}.")
-
-        os.remove(tar_file_path)
+        edge_install_path = get_edge_install(phases)
+        with timed_phase(phases, "populate"):
+            link_tree(edge_install_path, run_path)
 
         with open(os.path.join(run_path, "edge.license"), "w") as fp:
             fp.write(endpoint_token)
@@ -186,69 +370,33 @@ def endpoint_start(request_parms, port):
 
         # eyeflow_edge pack
         if not os.path.exists(os.path.join(run_path, "eyeflow_edge")):
-            sys.path.append(run_path)
-            import utils
-
-            pack_id = "64fb7933f257ab6cb37ce65d"
-            pack_name = "eyeflow_edge"
-            edge_pack = {
-                "name": pack_name,
-                "id": pack_id,
-                "version": "latest"
-            }
-
-            lib_pack = {
-                "name": "edge_sdk_libs",
-                "id": "65a987e1e90f2032a3886890",
-                "version": "latest"
-            }
-
-            pack_doc, pack_filename = utils.download_pack(endpoint_token, edge_pack, pack_folder=os.path.join(data_path, "tmp"))
-            with tarfile.open(pack_filename, 'r') as tar:
-                tar.extractall(run_path)
-
-        cmd = [
-            "docker",
-            "run",
-            "--log-driver=journald",
-            "--env", f"endpoint_id={endpoint_id}",
-            "--env", f'MQ_URL={MQ_URL}',
-            "--env", f"SERVICES_MANAGER_QUEUE={services_manager_queue}",
-            "--gpus", "all",
-            "-p", f"{port}:8001",
-            "--volume", f"{log_path}:/opt/eyeflow/log",
-            "--volume", f"{data_path}:/opt/eyeflow/data",
-            "--volume", f"{components_path}:/opt/eyeflow/components",
-            "--volume", f"{run_path}:/opt/eyeflow/run",
-            f"--name", container_id,
-            "--rm",
-            "--detach",
-            container_image
-        ]
-
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            log.error(f"Fail running endpoint: {endpoint_id} - {result.stderr.decode()}")
-            update_endpoint(request_parms, {
-                "status": "fail",
-                "logs": {
-                    "error": "endpoint_start_fail",
-                    "message": f"Fail running endpoint: {endpoint_id}. Fail starting container: {result.stdout.decode()}."
-                }
-            })
+            edge_pack_path = get_edge_pack(endpoint_token, edge_install_path, phases)
+            with timed_phase(phases, "populate"):
+                link_tree(edge_pack_path, run_path)
+
+        env = {
+            "endpoint_id": endpoint_id,
+            "MQ_URL": MQ_URL,
+            "SERVICES_MANAGER_QUEUE": services_manager_queue
+        }
+        config = get_container_config(container_image, port, endpoint_base_path, env)
 
-    except CalledProcessError as excp:
-        log.error('Fail running endpoint')
-        log.error(excp)
-        log.error(excp.stdout.decode())
-        log.error(excp.stderr.decode())
+        with timed_phase(phases, "docker_run"):
+            docker_api.run_container(container_id, config)
+
+        return True
+
+    except docker_api.DockerError as excp:
+        log.error(f"Fail running endpoint: {endpoint_id} - {excp}")
         update_endpoint(request_parms, {
             "status": "fail",
             "logs": {
                 "error": "endpoint_start_fail",
-                "message": f"Fail running endpoint: {endpoint_id}. Fail starting container: {excp.stdout.decode()}."
-            }
+                "message": f"Fail running endpoint: {endpoint_id}. Fail starting container: {excp}."
+            },
+            "phases": phases
         })
+        return False
     except Exception as excp:
         log.error('Fail running endpoint')
         log.error(traceback.format_exc())
@@ -257,8 +405,233 @@ def endpoint_start(request_parms, port):
             "logs": {
                 "error": "endpoint_start_fail",
                 "message": f"Fail running endpoint: {endpoint_id}. Fail starting container: {excp}."
-            }
+            },
+            "phases": phases
         })
+        return False
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def parse_standby_pool(pool_conf):
+    """
+    'image=count,image=count' -> {image: count}
+    """
+    standby_pool = {}
+    for item in pool_conf.split(","):
+        if "=" in item:
+            image, count = item.strip().rsplit("=", 1)
+            standby_pool[image] = int(count)
+
+    return standby_pool
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def start_standby(container_image):
+    """
+    Start an idle container of the image in a standby slot. The slot has the edge install and the cached
+    eyeflow_edge pack, and run_endpoint.sh waits in the container until the endpoint license is written.
+    A standby saves the container create/start and the slot setup: cloud_sync, prepare_models and the
+    CUDA/model load of eyeflow_edge need the endpoint and still run after the bind.
+    """
+    slot = uuid.uuid4().hex[:12]
+    container_id = f"standby_{slot}"
+    slot_path = os.path.join(STANDBY_PATH, slot)
+    edge_pack_path = get_cached_edge_pack()
+    if edge_pack_path is None:
+        log.info("Standby pool waits for the first endpoint start to cache the eyeflow_edge pack")
+        return None
+
+    port = None
+    try:
+        for folder in ["data", "log", "components", "run"]:
+            Path(os.path.join(slot_path, folder)).mkdir(parents=True, exist_ok=True)
+
+        link_tree(get_edge_install(), os.path.join(slot_path, "run"))
+        link_tree(edge_pack_path, os.path.join(slot_path, "run"))
+
+        port = allocate_port(container_id)
+        docker_api.run_container(container_id, get_container_config(container_image, port, slot_path, {"MQ_URL": MQ_URL}))
+    except Exception as excp:
+        log.error(f"Fail starting standby container {container_id} - {excp}")
+        if port is not None:
+            release_port(container_id)
+
+        shutil.rmtree(slot_path, ignore_errors=True)
+        return None
+
+    standby = {"slot": slot, "container_id": container_id, "path": slot_path, "port": port}
+    with _standby_lock:
+        _standby_pool.setdefault(container_image, []).append(standby)
+
+    log.info(f"Standby container started: {container_id} - {container_image} - port: {port}")
+    return standby
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def fill_standby_pool():
+    with _standby_fill_lock:
+        for container_image, size in STANDBY_POOL.items():
+            while len(_standby_pool.get(container_image, [])) < size:
+                if start_standby(container_image) is None:
+                    break
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def clear_standby_pool():
+    """
+    Remove the standby containers and slots left by a previous run of the agent
+    """
+    for container in docker_api.get_containers(prefix="standby_"):
+        try:
+            docker_api.remove_container(container["id"], force=True)
+        except docker_api.DockerError as excp:
+            log.warning(f"Fail removing standby container {container['name']} - {excp}")
+
+    shutil.rmtree(STANDBY_PATH, ignore_errors=True)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def move_folder_contents(src_root, dest_root, folder, moved):
+    """
+    Move the entries of src_root/folder into dest_root/folder, merging the folders present in both.
+    An entry of the destination in the way is kept as <name>.standby. The moves are recorded in moved
+    as (relative path, kept aside) for restore_folder_contents.
+    """
+    for name in os.listdir(os.path.join(src_root, folder)):
+        rel_path = os.path.join(folder, name)
+        src = os.path.join(src_root, rel_path)
+        dest = os.path.join(dest_root, rel_path)
+        if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dest) and not os.path.islink(dest):
+            move_folder_contents(src_root, dest_root, rel_path, moved)
+            continue
+
+        aside = os.path.lexists(dest)
+        if aside:
+            if os.path.isdir(dest + ".standby") and not os.path.islink(dest + ".standby"):
+                shutil.rmtree(dest + ".standby")
+
+            os.replace(dest, dest + ".standby")
+
+        os.rename(src, dest)
+        moved.append((rel_path, aside))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def restore_folder_contents(moved, src_root, dest_root):
+    """
+    Undo move_folder_contents, dest_root being where the moved entries are now
+    """
+    for rel_path, aside in reversed(moved):
+        dest = os.path.join(dest_root, rel_path)
+        os.rename(dest, os.path.join(src_root, rel_path))
+        if aside:
+            os.replace(dest + ".standby", dest)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def bind_standby(request_parms, phases=None):
+    """
+    Turn an idle standby container of the request image into the endpoint: the container is renamed,
+    its slot folder becomes the endpoint folder (the bind mounts follow the rename) and the license
+    is written last to release run_endpoint.sh. Returns the endpoint port, or None when no standby
+    container could be bound and the endpoint must be started cold.
+    """
+    endpoint_id = request_parms["endpoint_id"]
+    container_image = request_parms.get("container_image", "eyeflowai/eyeflow_endpoint-x86_64:latest")
+    with _standby_lock:
+        if not _standby_pool.get(container_image):
+            return None
+
+        standby = _standby_pool[container_image].pop(0)
+
+    _background_executor.submit(fill_standby_pool)
+    container_id = f"endpoint_{endpoint_id}"
+    endpoint_base_path = os.path.join(BASE_PATH, endpoint_id)
+    try:
+        with timed_phase(phases, "standby_bind"):
+            docker_api.rename_container(standby["container_id"], container_id)
+    except docker_api.DockerError as excp:
+        log.warning(f"Fail binding standby container {standby['container_id']} to {container_id} - {excp}")
+        with _standby_lock:
+            _standby_pool[container_image].append(standby)
+
+        return None
+
+    old_path = None
+    bound_path = standby["path"]
+    moved = []
+    try:
+        if os.path.isdir(endpoint_base_path):
+            # keep the data of a previous run of the endpoint. The files are moved into the slot folders,
+            # which are the ones mounted in the container, and moved back if the bind fails
+            old_path = endpoint_base_path + ".old"
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+
+            os.rename(endpoint_base_path, old_path)
+            for folder in ["data", "log", "components"]:
+                if os.path.isdir(os.path.join(old_path, folder)):
+                    Path(os.path.join(standby["path"], folder)).mkdir(parents=True, exist_ok=True)
+                    move_folder_contents(old_path, standby["path"], folder, moved)
+
+        os.rename(standby["path"], endpoint_base_path)
+        bound_path = endpoint_base_path
+        run_path = os.path.join(endpoint_base_path, "run")
+
+        # the cached assets may be newer than the ones of the slot
+        edge_install_path = get_edge_install(phases)
+        edge_pack_path = get_edge_pack(request_parms["endpoint_token"], edge_install_path, phases)
+        with timed_phase(phases, "populate"):
+            link_tree(edge_install_path, run_path)
+            link_tree(edge_pack_path, run_path)
+
+        with open(os.path.join(run_path, "endpoint.env"), "w") as fp:
+            fp.write(f"export endpoint_id={endpoint_id}\n")
+            fp.write(f"export SERVICES_MANAGER_QUEUE={request_parms.get('services_manager_queue', 'services_manager')}\n")
+
+        with open(os.path.join(run_path, "edge-key.pub"), "w") as fp:
+            fp.write(request_parms["pub_key"])
+
+        with open(os.path.join(run_path, "edge.license.tmp"), "w") as fp:
+            fp.write(request_parms["endpoint_token"])
+
+        os.replace(os.path.join(run_path, "edge.license.tmp"), os.path.join(run_path, "edge.license"))
+        rekey_port(standby["container_id"], endpoint_id)
+    except Exception as excp:
+        log.error(f"Fail binding standby container {standby['container_id']} to {container_id} - {excp}")
+        log.error(traceback.format_exc())
+        try:
+            docker_api.remove_container(container_id, force=True)
+        except docker_api.DockerError:
+            pass
+
+        release_port(standby["container_id"])
+        if old_path is not None:
+            try:
+                restore_folder_contents(moved, old_path, bound_path)
+            except Exception as excp:
+                log.error(f"Fail restoring the data of endpoint {endpoint_id}, kept in {bound_path} and {old_path} - {excp}")
+                return None
+
+        shutil.rmtree(bound_path, ignore_errors=True)
+        if old_path is not None:
+            os.rename(old_path, endpoint_base_path)
+
+        return None
+
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    # the files of the standby container that were in the way of the endpoint data
+    for rel_path, aside in moved:
+        aside_path = os.path.join(endpoint_base_path, rel_path + ".standby")
+        if aside and os.path.isdir(aside_path) and not os.path.islink(aside_path):
+            shutil.rmtree(aside_path, ignore_errors=True)
+        elif aside and os.path.lexists(aside_path):
+            os.remove(aside_path)
+
+    log.info(f"Endpoint {endpoint_id} bound to standby container {standby['container_id']} - port: {standby['port']}")
+    return standby["port"]
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -269,44 +642,32 @@ def endpoint_kill(request_parms):
     log.info(f"Killing endpoint container {container_id}")
 
     try:
-        cmd = [
-            "docker",
-            "stop",
-            container_id
-        ]
-
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            log.error(f"Fail stopping container: {container_id} - {result}")
-            return {
-                "status": "fail",
-                "message": f"Fail stopping container: {container_id} - {result}"
-            }
+        try:
+            docker_api.stop_container(container_id)
+        except docker_api.DockerError as excp:
+            # 404: the container is already gone, only the cleanup is left
+            if excp.status != 404:
+                log.error(f"Fail stopping container: {container_id} - {excp}")
+                return {
+                    "status": "fail",
+                    "message": f"Fail stopping container: {container_id} - {excp}"
+                }
 
         update_endpoint(request_parms, {
             "status": "stopped",
         })
 
-        os.remove(os.path.join(NGINX_CONF_PATH, endpoint_id + ".conf"))
+        release_port(endpoint_id)
 
-        cmd = [
-            "nginx",
-            "-s",
-            "reload"
-        ]
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            log.error(f"Fail reloading NGINX conf: {request_parms['endpoint_id']} - {result}")
+        remove_endpoint_conf(endpoint_id)
+        ok, message = nginx_reload()
+        if not ok:
+            log.error(f"Fail reloading NGINX conf: {request_parms['endpoint_id']} - {message}")
 
         return {
             "status": "success",
             "message": f"Endpoint container killed ID: {container_id}"
         }
-    except CalledProcessError as excp:
-        log.error('Fail killing container')
-        log.error(excp)
-        log.error(excp.stdout.decode())
-        log.error(excp.stderr.decode())
     except Exception as excp:
         log.error('Fail killing container')
         log.error(traceback.format_exc())
@@ -317,22 +678,212 @@ def endpoint_kill(request_parms):
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def SendHostInfo(request_parms):
+def get_disk_usage(mountpoint):
+    """
+    disk_usage of the mount with a timeout. A mount whose probe hangs (stale network mount)
+    is skipped until that probe returns.
+    """
+    with _disk_probe_lock:
+        if mountpoint in _stale_mounts:
+            return None
+
+        future = _disk_probe_executor.submit(psutil.disk_usage, mountpoint)
+
     try:
-        services_manager_queue = request_parms.get("services_manager_queue", "services_manager")
-        message = {
-            "operation": "set_host_info",
-            "hostname": socket.gethostname(),
-            "host_info": get_host_info(),
-            "host_type": "endpoint"
+        return future.result(timeout=DISK_PROBE_TIMEOUT)
+    except FutureTimeoutError:
+        log.warning(f"Disk usage of {mountpoint} timed out, skipping the mount")
+        with _disk_probe_lock:
+            _stale_mounts.add(mountpoint)
+
+        def probe_done(_):
+            with _disk_probe_lock:
+                _stale_mounts.discard(mountpoint)
+
+        future.add_done_callback(probe_done)
+        return None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_rate(value, prev_value, elapsed):
+    if prev_value is None or elapsed <= 0:
+        return 0
+
+    return round(max(0, value - prev_value) / elapsed, 1)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_host_counters(disk_io, net_io):
+    """
+    Cumulative disk and network counters of the host, summed over the disks and the network interfaces but loopback
+    """
+    counters = {}
+    if disk_io is not None:
+        counters["disk_read_bytes"] = disk_io.read_bytes
+        counters["disk_write_bytes"] = disk_io.write_bytes
+        counters["disk_read_count"] = disk_io.read_count
+        counters["disk_write_count"] = disk_io.write_count
+
+    for name in ["net_bytes_sent", "net_bytes_recv", "net_packets_sent", "net_packets_recv", "net_errors", "net_drops"]:
+        counters[name] = 0
+
+    for nic, nic_io in net_io.items():
+        if nic == "lo":
+            continue
+
+        counters["net_bytes_sent"] += nic_io.bytes_sent
+        counters["net_bytes_recv"] += nic_io.bytes_recv
+        counters["net_packets_sent"] += nic_io.packets_sent
+        counters["net_packets_recv"] += nic_io.packets_recv
+        counters["net_errors"] += nic_io.errin + nic_io.errout
+        counters["net_drops"] += nic_io.dropin + nic_io.dropout
+
+    return counters
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_host_info(prev_sample=None):
+    """
+    Host state, with the disk and network rates (per second) since prev_sample and the CPU use per core
+    since the last call. The raw psutil counters (disk_info io_*, net_info) are sent as before, next to the rates.
+    """
+    sample_time = time.time()
+    host_info = {}
+
+    cpu_freq = psutil.cpu_freq(percpu=False)
+    per_cpu = psutil.cpu_percent(interval=None, percpu=True)
+    host_info["cpu_info"] = {
+        "cpu_percent": round(sum(per_cpu) / len(per_cpu), 1) if per_cpu else 0,
+        "per_cpu": per_cpu,
+        "current_freq": cpu_freq.current if cpu_freq else 0,
+        "max_freq": cpu_freq.max if cpu_freq else 0
+    }
+
+    mem_data = psutil.virtual_memory()
+    host_info["memory_info"] = {
+        "total": mem_data.total,
+        "available": mem_data.available
+    }
+
+    host_info["disk_info"] = {
+        "mounts": []
+    }
+
+    try:
+        disk_io = psutil.disk_io_counters(perdisk=False)
+        host_info["disk_info"]["io_read_count"] = disk_io.read_count
+        host_info["disk_info"]["io_write_count"] = disk_io.write_count
+        host_info["disk_info"]["io_read_bytes"] = disk_io.read_bytes
+        host_info["disk_info"]["io_write_bytes"] = disk_io.write_bytes
+    except:
+        disk_io = None
+
+    for part in psutil.disk_partitions(all=False):
+        if 'cdrom' in part.mountpoint or part.fstype == '':
+            # skip cd-rom drives with no disk in it; they may raise
+            # ENOENT, pop-up a Windows GUI error for a non-ready
+            # partition or just hang.
+            continue
+
+        usage = get_disk_usage(part.mountpoint)
+        if usage is None:
+            continue
+
+        dsk = {
+            "device": part.device,
+            "total": usage.total,
+            "used": usage.used,
+            "free": usage.free,
+            "use": usage.percent,
+            "type": part.fstype,
+            "mount": part.mountpoint
+        }
+
+        host_info["disk_info"]["mounts"].append(dsk)
+
+    host_info["net_info"] = psutil.net_io_counters(pernic=True)
+
+    counters = get_host_counters(disk_io, host_info["net_info"])
+    elapsed = sample_time - prev_sample["time"] if prev_sample else 0
+    prev_counters = prev_sample["counters"] if prev_sample else {}
+    host_info["rates"] = {"interval": round(elapsed, 1)}
+    for name in HOST_RATE_COUNTERS:
+        host_info["rates"][name] = get_rate(counters[name], prev_counters.get(name), elapsed) if name in counters else 0
+
+    host_info["temperature_info"] = []
+    temp_info = dict(psutil.sensors_temperatures())
+    for sensor in temp_info:
+        sensor_info = {
+            "sensor": sensor,
+            "info": []
         }
 
+        for info in temp_info[sensor]:
+            sensor_info["info"].append({
+                "label": info.label,
+                "current": info.current,
+                "high": info.high,
+                "critical": info.critical
+            })
+
+        host_info["temperature_info"].append(sensor_info)
+
+    host_info["host_date"] = datetime.datetime.fromtimestamp(sample_time)
+
+    return {"time": sample_time, "counters": counters, "host_info": host_info, "gpu_info": get_gpu_info()}
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_gpu_info():
+    try:
         all_gpus = nv_gpu.gpu_info()
         with nv_gpu.nvml_context():
             for idx, gpu in enumerate(all_gpus):
                 all_gpus[idx].update(nv_gpu.device_status(int(gpu["index"])))
 
-        message["gpu_info"] = all_gpus
+        return all_gpus
+    except Exception as excp:
+        log.error(f'Fail getting GPU info - {excp}')
+        return []
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def host_sampler():
+    """
+    Background thread sampling the host every HOST_SAMPLE_INTERVAL seconds into a ring buffer
+    """
+    while True:
+        try:
+            prev_sample = _host_samples[-1] if _host_samples else None
+            _host_samples.append(get_host_info(prev_sample))
+        except Exception:
+            log.error('Fail sampling host info')
+            log.error(traceback.format_exc())
+
+        time.sleep(HOST_SAMPLE_INTERVAL)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_latest_host_info():
+    if not _host_samples:
+        _host_samples.append(get_host_info())
+
+    return _host_samples[-1]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def SendHostInfo(request_parms):
+    try:
+        services_manager_queue = request_parms.get("services_manager_queue", "services_manager")
+        sample = get_latest_host_info()
+        message = {
+            "operation": "set_host_info",
+            "hostname": socket.gethostname(),
+            "host_info": sample["host_info"],
+            "host_type": "endpoint",
+            "gpu_info": sample["gpu_info"]
+        }
+
         publish_message(message=message, queue=services_manager_queue)
     except Exception as excp:
         log.error('Fail in consumer loop')
@@ -341,58 +892,555 @@ def SendHostInfo(request_parms):
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def get_available_port():
-    conn_list = psutil.net_connections()
-    used_ports = [conn.laddr.port for conn in conn_list]
-    for port in range(PORT_RANGE[0], PORT_RANGE[1]):
-        if port not in used_ports:
-            return port
+def save_ports():
+    tmp_file = PORTS_FILE + ".tmp"
+    with open(tmp_file, "w") as fp:
+        json.dump(_port_map, fp, indent=2)
+
+    os.replace(tmp_file, PORTS_FILE)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_container_ports():
+    """
+    Host ports of the running endpoint containers: {endpoint_id: port}
+    """
+    container_ports = {}
+    for container in docker_api.get_containers(prefix="endpoint_", state="running"):
+        if "8001/tcp" in container["ports"]:
+            container_ports[container["name"][len("endpoint_"):]] = container["ports"]["8001/tcp"]
+
+    return container_ports
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def reconcile_ports():
+    """
+    Load the endpoint ports map and fix it from the running containers.
+    Returns the endpoints of the map whose container is not running anymore.
+    """
+    with _port_lock:
+        _port_map.clear()
+        if os.path.isfile(PORTS_FILE):
+            try:
+                with open(PORTS_FILE) as fp:
+                    _port_map.update(json.load(fp))
+            except Exception as excp:
+                log.warning(f"Fail reading {PORTS_FILE} - {excp}")
+
+        stale = set()
+        try:
+            container_ports = get_container_ports()
+            stale = set(_port_map) - set(container_ports)
+            if stale:
+                log.info(f"Releasing ports of stopped endpoints: {sorted(stale)}")
+
+            _port_map.clear()
+            _port_map.update(container_ports)
+        except Exception as excp:
+            log.warning(f"Fail listing endpoint containers, keeping {PORTS_FILE} - {excp}")
+
+        _free_ports.clear()
+        used_ports = set(_port_map.values())
+        _free_ports.extend(port for port in range(PORT_RANGE[0], PORT_RANGE[1]) if port not in used_ports)
+        Path(BASE_PATH).mkdir(parents=True, exist_ok=True)
+        save_ports()
+
+    return stale
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def is_port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def allocate_port(endpoint_id):
+    """
+    Reserve a port for the endpoint. Free ports are taken in order and bind-probed,
+    ports used by other processes go to the end of the list.
+    """
+    with _port_lock:
+        if endpoint_id in _port_map:
+            return _port_map[endpoint_id]
+
+        for _ in range(len(_free_ports)):
+            port = _free_ports.popleft()
+            if is_port_free(port):
+                _port_map[endpoint_id] = port
+                save_ports()
+                return port
+
+            _free_ports.append(port)
+
+    raise Exception(f"No port available in range {PORT_RANGE}")
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def publish_endpoint(request_parms, port):
-    conf_line = f"location /endpoint/{request_parms['endpoint_id']}/ {{ proxy_pass http://localhost:{port}/; }}\n"
-    with open(os.path.join(NGINX_CONF_PATH, request_parms['endpoint_id'] + ".conf"), "w") as fp:
-        fp.write(conf_line)
+def rekey_port(old_id, new_id):
+    """
+    Move the port of a standby container to the endpoint bound to it
+    """
+    with _port_lock:
+        _port_map[new_id] = _port_map.pop(old_id)
+        save_ports()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def release_port(endpoint_id):
+    with _port_lock:
+        port = _port_map.pop(endpoint_id, None)
+        if port is not None:
+            _free_ports.append(port)
+            save_ports()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class NginxReload:
+    """
+    One nginx reload shared by all the conf changes of a debounce window
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.message = ""
+        self.endpoint_ids = set()
+        self.failed = {}
+
+    def wait(self, endpoint_id=None):
+        self.done.wait()
+        if endpoint_id in self.failed:
+            return False, self.failed[endpoint_id]
+
+        return self.ok, self.message
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_nginx_conf():
+    result = subprocess.run(["nginx", "-t"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.returncode == 0, result.stderr.decode()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def quarantine_nginx_confs(reload):
+    """
+    Find the endpoints of the reload whose conf fails 'nginx -t': test without the confs of all of them,
+    then add them back one by one. The bad confs are left as '<conf>.bad' and their endpoints in reload.failed.
+    Returns False when the conf is invalid without the endpoints of the reload too.
+    """
+    aside = {}
+    for endpoint_id in sorted(reload.endpoint_ids):
+        aside[endpoint_id] = [filename for filename in get_endpoint_conf_files(endpoint_id) if os.path.isfile(filename)]
+        for filename in aside[endpoint_id]:
+            os.replace(filename, filename + ".bad")
+
+    ok, message = test_nginx_conf()
+    if not ok:
+        for filenames in aside.values():
+            for filename in filenames:
+                os.replace(filename + ".bad", filename)
+
+        return False
+
+    for endpoint_id, filenames in aside.items():
+        if not filenames:
+            continue
+
+        for filename in filenames:
+            os.replace(filename + ".bad", filename)
+
+        ok, message = test_nginx_conf()
+        if not ok:
+            for filename in filenames:
+                os.replace(filename, filename + ".bad")
+
+            reload.failed[endpoint_id] = f"Invalid NGINX conf: {message}"
+            log.error(f"NGINX conf of endpoint {endpoint_id} quarantined - {message}")
+
+    return True
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    cmd = [
-        "nginx",
-        "-s",
-        "reload"
+
+def run_nginx_reload():
+    global _pending_reload
+
+    with _reload_run_lock:
+        with _reload_lock:
+            reload = _pending_reload
+            _pending_reload = None
+
+        try:
+            ok, message = test_nginx_conf()
+            # a bad conf only fails its own endpoint, the others of the batch are reloaded
+            if not ok and quarantine_nginx_confs(reload):
+                ok = True
+
+            if not ok:
+                reload.message = f"Invalid NGINX conf: {message}"
+            else:
+                result = subprocess.run(["nginx", "-s", "reload"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if result.returncode != 0:
+                    reload.message = f"Fail reloading NGINX conf: {result.stderr.decode()}"
+                else:
+                    reload.ok = True
+        except Exception as excp:
+            reload.message = f"Fail reloading NGINX conf: {excp}"
+
+        if not reload.ok:
+            log.error(reload.message)
+
+        reload.done.set()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def nginx_reload(endpoint_id=None):
+    """
+    Request an nginx reload and wait for it. The requests of NGINX_RELOAD_WINDOW seconds are
+    coalesced in one 'nginx -t' and 'nginx -s reload'. Returns (ok, message).
+    endpoint_id is the endpoint whose conf was written: when its conf is invalid only that endpoint fails.
+    """
+    global _pending_reload
+
+    with _reload_lock:
+        if _pending_reload is None:
+            _pending_reload = NginxReload()
+            timer = threading.Timer(NGINX_RELOAD_WINDOW, run_nginx_reload)
+            timer.daemon = True
+            timer.start()
+
+        reload = _pending_reload
+        if endpoint_id is not None:
+            reload.endpoint_ids.add(endpoint_id)
+
+    return reload.wait(endpoint_id)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_endpoint_conf_files(endpoint_id):
+    return [
+        os.path.join(NGINX_UPSTREAM_CONF_PATH, f"endpoint_{endpoint_id}.conf"),
+        os.path.join(NGINX_CONF_PATH, endpoint_id + ".conf")
     ]
-    result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        log.error(f"Fail reloading NGINX conf: {request_parms['endpoint_id']} - {result}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def write_endpoint_conf(endpoint_id, port):
+    """
+    Upstream block with keepalive connections to the container, and the location proxying to it
+    """
+    upstream_file, location_file = get_endpoint_conf_files(endpoint_id)
+    upstream_conf = (
+        f"upstream endpoint_{endpoint_id} {{\n"
+        f"    server 127.0.0.1:{port};\n"
+        f"    keepalive {NGINX_KEEPALIVE};\n"
+        f"}}\n"
+    )
+    location_conf = (
+        f"location /endpoint/{endpoint_id}/ {{\n"
+        f"    proxy_pass http://endpoint_{endpoint_id}/;\n"
+        f"    proxy_http_version 1.1;\n"
+        f"    proxy_set_header Connection \"\";\n"
+        f"}}\n"
+    )
+    for filename, conf in [(upstream_file, upstream_conf), (location_file, location_conf)]:
+        with open(filename + ".tmp", "w") as fp:
+            fp.write(conf)
+
+        os.replace(filename + ".tmp", filename)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remove_endpoint_conf(endpoint_id):
+    # the location goes first, so the upstream is never missing while it is used
+    for filename in reversed(get_endpoint_conf_files(endpoint_id)):
+        # with the confs quarantined by a failed reload
+        for conf_file in [filename, filename + ".bad"]:
+            if os.path.isfile(conf_file):
+                os.remove(conf_file)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def wait_endpoint_ready(port, timeout):
+    """
+    Poll the endpoint port until its HTTP server answers. Returns False on timeout
+    """
+    url = f"http://127.0.0.1:{port}{ENDPOINT_HEALTH_PATH}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = requests.get(url, timeout=1)
+            if response.status_code < 500:
+                return True
+        except requests.RequestException:
+            pass
+
+        time.sleep(READY_POLL_INTERVAL)
+
+    return False
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def log_endpoint_start(request_parms, status, phases):
+    log.info(json.dumps({
+        "event": "endpoint_start",
+        "endpoint_id": request_parms["endpoint_id"],
+        "status": status,
+        "total": round(sum(phases.values()), 3),
+        "phases": phases
+    }, separators=(',', ':')))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def discard_endpoint(endpoint_id):
+    """
+    Undo a failed start: remove the container, release its port and delete its nginx conf
+    """
+    try:
+        docker_api.remove_container(f"endpoint_{endpoint_id}", force=True)
+    except docker_api.DockerError as excp:
+        if excp.status != 404:
+            log.error(f"Fail removing container of endpoint {endpoint_id} - {excp}")
+
+    release_port(endpoint_id)
+    remove_endpoint_conf(endpoint_id)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def publish_endpoint(request_parms, port, phases=None):
+    """
+    Wait for the endpoint to answer on its port, then route it in nginx and report it active.
+    On a failure the container, its port and its nginx conf are removed before reporting it.
+    """
+    phases = {} if phases is None else phases
+    with timed_phase(phases, "readiness"):
+        ready = wait_endpoint_ready(port, READY_TIMEOUT)
+
+    if not ready:
+        log.error(f"Endpoint not ready: {request_parms['endpoint_id']} - port: {port}")
+        discard_endpoint(request_parms['endpoint_id'])
+        log_endpoint_start(request_parms, "fail", phases)
+        update_endpoint(request_parms, {
+            "status": "fail",
+            "logs": {
+                "error": "endpoint_start_fail",
+                "message": f"Fail running endpoint: {request_parms['endpoint_id']}. Endpoint not ready after {READY_TIMEOUT}s."
+            },
+            "phases": phases
+        })
+        return
+
+    with timed_phase(phases, "nginx_reload"):
+        write_endpoint_conf(request_parms['endpoint_id'], port)
+        ok, message = nginx_reload(request_parms['endpoint_id'])
+
+    if not ok:
+        log.error(f"Fail reloading NGINX conf: {request_parms['endpoint_id']} - {message}")
+        discard_endpoint(request_parms['endpoint_id'])
+        log_endpoint_start(request_parms, "fail", phases)
         update_endpoint(request_parms, {
             "status": "fail",
             "logs": {
                 "error": "endpoint_start_fail",
-                "message": f"Fail running endpoint: {request_parms['endpoint_id']}. Fail reloading NGINX conf: {result}."
-            }
+                "message": f"Fail running endpoint: {request_parms['endpoint_id']}. Fail reloading NGINX conf: {message}."
+            },
+            "phases": phases
         })
         return
 
+    log_endpoint_start(request_parms, "active", phases)
     update_endpoint(request_parms, {
         "status": "active",
         "endpoint_url": SERVER_URL + f"/endpoint/{request_parms['endpoint_id']}",
         "hostname": request_parms["hostname"],
         "host_gpu": request_parms["host_gpu"],
+        "phases": phases
     })
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def on_request(channel, basic_deliver, properties, body):
+def submit_endpoint_task(endpoint_id, fn, *args):
     """
-    Request callback.
+    Run fn(*args) in the worker pool after the tasks of the endpoint already submitted. A task is only
+    submitted to the pool when the previous one of the endpoint is done, so no worker waits on another.
     """
-    request_parms = json.loads(body.decode())
-    # log.info(f"Endpoint Agent request {request_parms}")
+    with _endpoint_tasks_lock:
+        if endpoint_id in _endpoint_tasks:
+            _endpoint_tasks[endpoint_id].append((fn, args))
+            return
 
+        _endpoint_tasks[endpoint_id] = collections.deque()
+
+    _executor.submit(run_endpoint_task, endpoint_id, fn, args)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def run_endpoint_task(endpoint_id, fn, args):
+    try:
+        fn(*args)
+    except Exception:
+        log.error(f"Fail running task of endpoint {endpoint_id}")
+        log.error(traceback.format_exc())
+    finally:
+        with _endpoint_tasks_lock:
+            if _endpoint_tasks[endpoint_id]:
+                next_fn, next_args = _endpoint_tasks[endpoint_id].popleft()
+            else:
+                # no task left, the endpoint entry is removed
+                del _endpoint_tasks[endpoint_id]
+                next_fn = None
+
+        if next_fn is not None:
+            _executor.submit(run_endpoint_task, endpoint_id, next_fn, next_args)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_endpoint_parms(endpoint_id):
+    """
+    Request parms of an endpoint rebuilt from the license files of its folder, or None
+    """
+    run_path = os.path.join(BASE_PATH, endpoint_id, "run")
+    try:
+        with open(os.path.join(run_path, "edge.license")) as fp:
+            endpoint_token = fp.read()
+
+        with open(os.path.join(run_path, "edge-key.pub")) as fp:
+            pub_key = fp.read()
+    except OSError:
+        return None
+
+    return {"endpoint_id": endpoint_id, "endpoint_token": endpoint_token, "pub_key": pub_key}
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def endpoint_stopped(endpoint_id):
+    """
+    Cleanup of an endpoint container that exited without an endpoint_stop: port, nginx conf and status.
+    Runs as a task of the endpoint, after its pending requests.
+    """
+    container = docker_api.get_container(f"endpoint_{endpoint_id}")
+    if endpoint_id not in _port_map or (container is not None and container["state"] == "running"):
+        # already cleaned by endpoint_kill, or started again
+        return
+
+    log.warning(f"Endpoint container exited: {endpoint_id}")
+    release_port(endpoint_id)
+    remove_endpoint_conf(endpoint_id)
+    ok, message = nginx_reload()
+    if not ok:
+        log.error(f"Fail reloading NGINX conf: {endpoint_id} - {message}")
+
+    request_parms = get_endpoint_parms(endpoint_id)
+    if request_parms is not None:
+        update_endpoint(request_parms, {"status": "stopped"})
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def on_container_event(action, container):
+    """
+    Docker event callback, runs in the event thread
+    """
+    if action != "die":
+        return
+
+    if container["name"].startswith("endpoint_"):
+        endpoint_id = container["name"][len("endpoint_"):]
+        submit_endpoint_task(endpoint_id, endpoint_stopped, endpoint_id)
+    elif container["name"].startswith("standby_"):
+        with _standby_lock:
+            standby = None
+            for standby_list in _standby_pool.values():
+                for item in standby_list:
+                    if item["container_id"] == container["name"]:
+                        standby = item
+                        standby_list.remove(item)
+                        break
+
+        if standby is not None:
+            log.warning(f"Standby container exited: {standby['container_id']}")
+            release_port(standby["container_id"])
+            shutil.rmtree(standby["path"], ignore_errors=True)
+            _background_executor.submit(fill_standby_pool)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def reconcile_endpoints(stale):
+    """
+    Align the nginx confs and the endpoint status with the running containers at startup.
+    stale are the endpoints that were running before the restart of the agent, they are reported
+    as stopped. The endpoint folders are kept, a new start of the endpoint reuses its data.
+    """
+    conf_endpoints = set()
+    if os.path.isdir(NGINX_UPSTREAM_CONF_PATH):
+        for filename in os.listdir(NGINX_UPSTREAM_CONF_PATH):
+            if filename.startswith("endpoint_") and filename.endswith(".conf"):
+                conf_endpoints.add(filename[len("endpoint_"):-len(".conf")])
+
+    for endpoint_id in stale:
+        if os.path.isfile(os.path.join(NGINX_CONF_PATH, endpoint_id + ".conf")):
+            conf_endpoints.add(endpoint_id)
+
+    for endpoint_id in sorted(conf_endpoints - set(_port_map)):
+        log.info(f"Removing NGINX conf of stopped endpoint: {endpoint_id}")
+        remove_endpoint_conf(endpoint_id)
+
+    # endpoints started before get the upstream keepalive conf
+    for endpoint_id, port in _port_map.items():
+        if not endpoint_id.startswith("standby_"):
+            write_endpoint_conf(endpoint_id, port)
+
+    if conf_endpoints or _port_map:
+        ok, message = nginx_reload()
+        if not ok:
+            log.error(f"Fail reloading NGINX conf - {message}")
+
+    for endpoint_id in sorted(stale):
+        if endpoint_id.startswith("standby_"):
+            continue
+
+        request_parms = get_endpoint_parms(endpoint_id)
+        if request_parms is None:
+            continue
+
+        try:
+            update_endpoint(request_parms, {"status": "stopped"})
+        except Exception as excp:
+            log.warning(f"Fail updating status of stopped endpoint {endpoint_id} - {excp}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def ack_message(channel, delivery_tag):
+    if channel.is_open:
+        channel.basic_ack(delivery_tag)
+    else:
+        log.warning(f"Channel closed, can not ack message {delivery_tag}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def process_request(request_parms):
     operation = request_parms.get("operation")
     if operation == "endpoint_start":
-        port = get_available_port()
-        endpoint_start(request_parms, port)
-        publish_endpoint(request_parms, port)
+        phases = {}
+        port = bind_standby(request_parms, phases)
+        if port is not None:
+            publish_endpoint(request_parms, port, phases)
+            return
+
+        # a port already mapped belongs to a running container, keep it if the start fails
+        had_port = request_parms["endpoint_id"] in _port_map
+        port = allocate_port(request_parms["endpoint_id"])
+        if endpoint_start(request_parms, port, phases):
+            publish_endpoint(request_parms, port, phases)
+            return
+
+        log_endpoint_start(request_parms, "fail", phases)
+        if not had_port:
+            release_port(request_parms["endpoint_id"])
     elif operation == "endpoint_stop":
         endpoint_kill(request_parms)
     elif operation == "get_host_info":
@@ -402,6 +1450,54 @@ def on_request(channel, basic_deliver, properties, body):
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
+def handle_request(connection, channel, delivery_tag, body, received_time):
+    """
+    Run a request in the worker pool, and ack the message from the connection thread when it is done
+    """
+    start_time = time.time()
+    operation = None
+    endpoint_id = None
+    result = "fail"
+    try:
+        request_parms = json.loads(body.decode())
+        operation = request_parms.get("operation")
+        endpoint_id = request_parms.get("endpoint_id")
+        process_request(request_parms)
+        result = "done"
+    except Exception as excp:
+        log.error(f'Fail processing request {operation} - endpoint: {endpoint_id} - {excp}')
+        log.error(traceback.format_exc())
+    finally:
+        end_time = time.time()
+        log.info(f"Operation {operation} - endpoint: {endpoint_id} - queue wait: {start_time - received_time:.3f}s - service time: {end_time - start_time:.3f}s")
+        OPERATIONS.inc(operation=str(operation), result=result)
+        OPERATION_WAIT_SECONDS.observe(start_time - received_time, operation=str(operation))
+        OPERATION_SECONDS.observe(end_time - start_time, operation=str(operation))
+        ENDPOINTS.set(len([key for key in _port_map if not key.startswith("standby_")]))
+        try:
+            connection.add_callback_threadsafe(functools.partial(ack_message, channel, delivery_tag))
+        except Exception as excp:
+            log.warning(f"Fail acking message {delivery_tag} - {excp}")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def on_request(channel, basic_deliver, properties, body, connection):
+    """
+    Request callback. Only dispatches the request, so the connection keeps serving heartbeats.
+    The requests of the same endpoint run one at a time, in the order received.
+    """
+    try:
+        endpoint_id = json.loads(body.decode()).get("endpoint_id")
+    except Exception:
+        endpoint_id = None
+
+    if endpoint_id is None:
+        _executor.submit(handle_request, connection, channel, basic_deliver.delivery_tag, body, time.time())
+    else:
+        submit_endpoint_task(endpoint_id, handle_request, connection, channel, basic_deliver.delivery_tag, body, time.time())
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
 def main():
     """
     Start message queue consumer for all queues
@@ -409,6 +1505,14 @@ def main():
 
     try:
         hostname = socket.gethostname()
+        threading.Thread(target=host_sampler, daemon=True).start()
+        metrics.start_http_server(port=METRICS_PORT)
+        docker_api.add_event_callback(on_container_event)
+        docker_api.start_event_watcher()
+        clear_standby_pool()
+        reconcile_endpoints(reconcile_ports())
+
+        _background_executor.submit(fill_standby_pool)
 
         while True:
             try:
@@ -419,12 +1523,12 @@ def main():
                 mq_channel.exchange_declare(exchange=SERVICES_MANAGER_BROADCAST_QUEUE, exchange_type='fanout')
                 mq_channel.queue_declare(queue=queue_name, exclusive=True)
                 mq_channel.queue_bind(exchange=SERVICES_MANAGER_BROADCAST_QUEUE, queue=queue_name)
-                mq_channel.basic_qos(prefetch_count=1)
-                mq_channel.basic_consume(queue=queue_name, on_message_callback=on_request, auto_ack=True)
+                mq_channel.basic_qos(prefetch_count=WORKERS)
+                mq_channel.basic_consume(queue=queue_name, on_message_callback=functools.partial(on_request, connection=mq_connection), auto_ack=False)
 
                 # SendHostInfo({"services_manager_queue": SERVICES_MANAGER_QUEUE})
 
-                log.info(f"EndpointAgent Awaiting requests Queue: {queue_name}. Queue: {SERVICES_MANAGER_QUEUE}. Broadcast: {SERVICES_MANAGER_BROADCAST_QUEUE}")
+                log.info(f"EndpointAgent Awaiting requests Queue: {queue_name}. Queue: {SERVICES_MANAGER_QUEUE}. Broadcast: {SERVICES_MANAGER_BROADCAST_QUEUE}. Workers: {WORKERS}")
                 mq_channel.start_consuming()
             except Exception as excp:
                 log.error('Fail in consumer loop')
@@ -443,11 +1547,77 @@ def main():
 BASE_PATH = "/opt/endpoint"
 EDGE_INSTALL_URL = "https://github.com/Eyeflow-AI/eyeflow_install/releases/latest/download/edge_install.tar.gz"
 EDGE_INSTALL_FILE = "edge_install.tar.gz"
+EDGE_INSTALL_FILE_LIST = [
+    "eyeflow_conf.json",
+    "run_endpoint.sh",
+    "cloud_sync.py",
+    "upgrade_edge",
+    "upload_extracts.py",
+    "utils.py",
+    "blob_store.py",
+    "http_client.py",
+    "extract_index.py",
+    "metrics.py",
+    "pack_resolver.py"
+]
+FICLONE = 0x40049409
+CACHE_PATH = os.path.join(BASE_PATH, ".cache")
+STANDBY_PATH = os.path.join(BASE_PATH, ".standby")
+BLOB_STORE_PATH = os.environ.get("BLOB_STORE_PATH", "/opt/eyeflow/blobs")  # host blob store, shared by the endpoint containers
 MQ_URL = os.environ["MQ_URL"]
 SERVICES_MANAGER_QUEUE = os.environ.get("SERVICES_MANAGER_QUEUE", "services_manager") # "services_manager_dev"
 SERVICES_MANAGER_BROADCAST_QUEUE = os.environ.get("SERVICES_MANAGER_BROADCAST_QUEUE", "services_manager_broadcast") # "services_manager_broadcast_dev"
 PORT_RANGE = [8100, 8150]
+PORTS_FILE = os.path.join(BASE_PATH, "ports.json")
 SERVER_URL = os.environ.get("SERVER_URL", "https://endpoint-1.eyeflow.ai")
-NGINX_CONF_PATH = "/etc/nginx/api_conf.d/"
+NGINX_CONF_PATH = os.environ.get("NGINX_CONF_PATH", "/etc/nginx/api_conf.d/")
+NGINX_UPSTREAM_CONF_PATH = os.environ.get("NGINX_UPSTREAM_CONF_PATH", "/etc/nginx/conf.d/")
+NGINX_KEEPALIVE = int(os.environ.get("NGINX_KEEPALIVE", 16))
+NGINX_RELOAD_WINDOW = float(os.environ.get("NGINX_RELOAD_WINDOW", 1.0))
+HOST_SAMPLE_INTERVAL = float(os.environ.get("HOST_SAMPLE_INTERVAL", 5))
+HOST_SAMPLE_HISTORY = int(os.environ.get("HOST_SAMPLE_HISTORY", 60))
+HOST_RATE_COUNTERS = [
+    "disk_read_bytes",
+    "disk_write_bytes",
+    "disk_read_count",
+    "disk_write_count",
+    "net_bytes_sent",
+    "net_bytes_recv",
+    "net_packets_sent",
+    "net_packets_recv",
+    "net_errors",
+    "net_drops"
+]
+DISK_PROBE_TIMEOUT = float(os.environ.get("DISK_PROBE_TIMEOUT", 2))
+ENDPOINT_HEALTH_PATH = os.environ.get("ENDPOINT_HEALTH_PATH", "/")
+READY_TIMEOUT = float(os.environ.get("ENDPOINT_READY_TIMEOUT", 600))
+READY_POLL_INTERVAL = float(os.environ.get("ENDPOINT_READY_POLL_INTERVAL", 0.25))
+STANDBY_POOL = parse_standby_pool(os.environ.get("ENDPOINT_STANDBY_POOL", ""))  # "image=count,image=count"
+WORKERS = int(os.environ.get("ENDPOINT_AGENT_WORKERS", 4))
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None  # None: CONFIG["metrics"]["port"]
+
+OPERATIONS = metrics.counter("eyeflow_endpoint_operations_total", "Endpoint agent operations, by result", ["operation", "result"])
+OPERATION_SECONDS = metrics.histogram("eyeflow_endpoint_operation_seconds", "Service time of the endpoint agent operations", ["operation"])
+OPERATION_WAIT_SECONDS = metrics.histogram("eyeflow_endpoint_operation_wait_seconds", "Queue wait of the endpoint agent operations", ["operation"])
+ENDPOINTS = metrics.gauge("eyeflow_endpoints", "Endpoints with a port allocated on the host")
+
+_cache_lock = threading.Lock()
+_endpoint_tasks = {}
+_endpoint_tasks_lock = threading.Lock()
+_port_map = {}
+_free_ports = collections.deque()
+_port_lock = threading.Lock()
+_pending_reload = None
+_reload_lock = threading.Lock()
+_reload_run_lock = threading.Lock()
+_host_samples = collections.deque(maxlen=HOST_SAMPLE_HISTORY)
+_stale_mounts = set()
+_disk_probe_lock = threading.Lock()
+_disk_probe_executor = ThreadPoolExecutor(max_workers=4)
+_standby_pool = {}
+_standby_lock = threading.Lock()
+_standby_fill_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=WORKERS)
+_background_executor = ThreadPoolExecutor(max_workers=1)
 
 main()
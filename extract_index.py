@@ -0,0 +1,229 @@
+"""
+SiliconLife Eyeflow
+Local SQLite index of the datasets and extract files
+
+Datasets (id, name, long_name) are read from the model folder and the extract files (size, mtime,
+labels) from the extract folders. Both are refreshed incrementally: a dataset file or an extract
+file is only read again when its mtime (or size) changes.
+"""
+
+import os
+import json
+import sqlite3
+import datetime
+from contextlib import closing
+
+from eyeflow_sdk.log_obj import CONFIG, log
+
+import utils
+
+INDEX_FILE = CONFIG["file-service"].get("extract_index", os.path.join(CONFIG["file-service"]["data_folder"], "extract_index.db"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    long_name TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets(name);
+CREATE INDEX IF NOT EXISTS datasets_long_name ON datasets(long_name);
+CREATE TABLE IF NOT EXISTS extract_files (
+    dataset_id TEXT,
+    name TEXT,
+    example TEXT,
+    size INTEGER,
+    mtime REAL,
+    mtime_ns INTEGER,
+    PRIMARY KEY (dataset_id, name)
+);
+CREATE INDEX IF NOT EXISTS extract_files_example ON extract_files(dataset_id, example);
+CREATE TABLE IF NOT EXISTS extract_labels (
+    dataset_id TEXT,
+    example TEXT,
+    label TEXT
+);
+CREATE INDEX IF NOT EXISTS extract_labels_label ON extract_labels(dataset_id, label);
+CREATE INDEX IF NOT EXISTS extract_labels_example ON extract_labels(dataset_id, example);
+"""
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def connect():
+    os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
+    conn = sqlite3.connect(INDEX_FILE, timeout=30)
+    conn.executescript(SCHEMA)
+    # index files written before mtime_ns: their rows are read again once
+    if "mtime_ns" not in [column[1] for column in conn.execute("PRAGMA table_info(extract_files)")]:
+        conn.execute("ALTER TABLE extract_files ADD COLUMN mtime_ns INTEGER")
+
+    return conn
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def refresh_datasets(conn):
+    """
+    Read again the dataset files of the model folder that changed since the last refresh
+    """
+    model_folder = CONFIG["file-service"]["model"]
+    indexed = dict(conn.execute("SELECT id, mtime_ns FROM datasets"))
+    found = set()
+    if os.path.isdir(model_folder):
+        with os.scandir(model_folder) as it:
+            for entry in it:
+                dataset_file = os.path.join(entry.path, entry.name + ".json")
+                try:
+                    mtime_ns = os.stat(dataset_file).st_mtime_ns
+                except OSError:
+                    continue
+
+                found.add(entry.name)
+                if indexed.get(entry.name) == mtime_ns:
+                    continue
+
+                try:
+                    with open(dataset_file) as fp:
+                        dset_data = json.load(fp)
+                except Exception as excp:
+                    log.warning(f"Fail reading dataset {dataset_file} - {excp}")
+                    continue
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO datasets (id, name, long_name, mtime_ns) VALUES (?, ?, ?, ?)",
+                    (entry.name, dset_data.get("name"), dset_data.get("info", {}).get("long_name"), mtime_ns)
+                )
+
+    for dataset_id in set(indexed) - found:
+        conn.execute("DELETE FROM datasets WHERE id = ?", (dataset_id,))
+
+    conn.commit()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_extract_labels(filename):
+    with open(filename) as fp:
+        extract_data = json.load(fp)
+
+    labels = set()
+    for instance in extract_data.get("annotations", {}).get("instances", []):
+        label = instance.get("label", instance.get("class"))
+        if label is not None:
+            labels.add(str(label))
+
+    return labels
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def refresh_extract(conn, dataset_id):
+    """
+    Update the extract files of dataset_id. The folder is listed on every call (a _data.json rewritten
+    in place does not change the folder mtime) and only new or changed files are parsed.
+    """
+    extract_path = os.path.join(CONFIG["file-service"]["extract"], dataset_id)
+    indexed = {name: (size, mtime_ns) for name, size, mtime_ns in conn.execute("SELECT name, size, mtime_ns FROM extract_files WHERE dataset_id = ?", (dataset_id,))}
+    entries = {}
+    if os.path.isdir(extract_path):
+        with os.scandir(extract_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    entries[entry.name] = entry.stat()
+
+    example_keys = utils.get_extract_example_keys(list(entries))
+    for name in set(indexed) - set(entries):
+        conn.execute("DELETE FROM extract_files WHERE dataset_id = ? AND name = ?", (dataset_id, name))
+        if name.endswith("_data.json"):
+            conn.execute("DELETE FROM extract_labels WHERE dataset_id = ? AND example = ?", (dataset_id, name[:-len("_data.json")]))
+
+    for name, stat in entries.items():
+        if indexed.get(name) == (stat.st_size, stat.st_mtime_ns):
+            continue
+
+        conn.execute(
+            "INSERT OR REPLACE INTO extract_files (dataset_id, name, example, size, mtime, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+            (dataset_id, name, example_keys.get(name), stat.st_size, stat.st_mtime, stat.st_mtime_ns)
+        )
+        if name.endswith("_data.json"):
+            example = name[:-len("_data.json")]
+            conn.execute("DELETE FROM extract_labels WHERE dataset_id = ? AND example = ?", (dataset_id, example))
+            try:
+                labels = get_extract_labels(os.path.join(extract_path, name))
+            except Exception as excp:
+                log.warning(f"Fail reading extract {name} - {excp}")
+                labels = set()
+
+            conn.executemany(
+                "INSERT INTO extract_labels (dataset_id, example, label) VALUES (?, ?, ?)",
+                [(dataset_id, example, label) for label in labels]
+            )
+
+    # files written before their _data.json have no example yet
+    for name, example in conn.execute("SELECT name, example FROM extract_files WHERE dataset_id = ?", (dataset_id,)).fetchall():
+        if example != example_keys.get(name):
+            conn.execute("UPDATE extract_files SET example = ? WHERE dataset_id = ? AND name = ?", (example_keys.get(name), dataset_id, name))
+
+    conn.commit()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def find_datasets(dataset):
+    """
+    Return the ids of the datasets with the id, name or long_name, the exact id first
+    """
+    with closing(connect()) as conn:
+        refresh_datasets(conn)
+        rows = conn.execute(
+            "SELECT id FROM datasets WHERE id = ? OR name = ? OR long_name = ? ORDER BY id = ? DESC, id",
+            (dataset, dataset, dataset, dataset)
+        ).fetchall()
+
+    return [row[0] for row in rows]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_class_counts(dataset_id):
+    """
+    Number of extract examples of dataset_id with each label
+    """
+    with closing(connect()) as conn:
+        refresh_extract(conn, dataset_id)
+        return dict(conn.execute(
+            "SELECT label, COUNT(DISTINCT example) FROM extract_labels WHERE dataset_id = ? GROUP BY label ORDER BY label",
+            (dataset_id,)
+        ))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def select_examples(dataset_id, only_class=None, since=None, limit=None):
+    """
+    Extract examples of dataset_id, from the oldest, in the format of utils.get_extract_examples.
+    only_class keeps the examples with an instance of the label, since (datetime) the examples written after it.
+    """
+    query = "SELECT f.example, f.mtime FROM extract_files f WHERE f.dataset_id = ? AND f.name = f.example || '_data.json'"
+    params = [dataset_id]
+    if only_class is not None:
+        query += " AND EXISTS (SELECT 1 FROM extract_labels l WHERE l.dataset_id = f.dataset_id AND l.example = f.example AND l.label = ?)"
+        params.append(str(only_class))
+
+    if since is not None:
+        query += " AND f.mtime >= ?"
+        params.append(since.timestamp() if isinstance(since, datetime.datetime) else since)
+
+    query += " ORDER BY f.mtime"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    with closing(connect()) as conn:
+        refresh_extract(conn, dataset_id)
+        examples = []
+        for example, mtime in conn.execute(query, params).fetchall():
+            files = conn.execute("SELECT name, size FROM extract_files WHERE dataset_id = ? AND example = ?", (dataset_id, example)).fetchall()
+            examples.append({
+                "key": example,
+                "files": [name for name, _ in files],
+                "bytes": sum(size for _, size in files),
+                "mtime": mtime
+            })
+
+    return examples
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,156 @@
+"""
+SiliconLife Eyeflow
+Shared HTTP client for the cloud calls
+
+Keeps one keep-alive session pool per host, applies default connect/read timeouts and the proxies
+from CONFIG["proxies"], and retries idempotent calls with jittered exponential backoff.
+"""
+
+import time
+import random
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from eyeflow_sdk.log_obj import CONFIG, log
+
+proxies = {}
+if "proxies" in CONFIG:
+    proxies = CONFIG["proxies"]
+
+http_conf = CONFIG.get("http", {})
+DEFAULT_TIMEOUT = (http_conf.get("connect_timeout", 10), http_conf.get("read_timeout", 120))
+MAX_RETRIES = http_conf.get("max_retries", 4)
+BACKOFF_FACTOR = http_conf.get("backoff_factor", 0.5)
+MAX_BACKOFF = http_conf.get("max_backoff", 30)
+POOL_SIZE = http_conf.get("pool_size", 16)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+_sessions = {}
+_stats = {}
+_lock = threading.Lock()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_session(url):
+    """
+    Get the pooled session of the url host
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.proxies.update(proxies)
+            _sessions[host] = session
+            _stats[host] = {"requests": 0, "retries": 0}
+
+    return host, _sessions[host]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_backoff(attempt, response=None):
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(MAX_BACKOFF, int(response.headers["Retry-After"]))
+
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_FACTOR * (2 ** attempt)))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def request(method, url, retry=None, **kwargs):
+    """
+    Send a request through the host session. By default only idempotent methods are retried,
+    pass retry=True for a POST that is safe to repeat, or retry=False for a body that can not be re-sent.
+    """
+    method = method.upper()
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if retry is None:
+        retry = method in IDEMPOTENT_METHODS
+
+    host, session = get_session(url)
+    attempts = MAX_RETRIES + 1 if retry else 1
+    for attempt in range(attempts):
+        with _lock:
+            _stats[host]["requests"] += 1
+
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS or attempt == attempts - 1:
+                return response
+
+            log.warning(f"HTTP {method} {host} returned {response.status_code}. Retry {attempt + 1}/{MAX_RETRIES}")
+            response.close()
+        except (requests.ConnectionError, requests.Timeout) as excp:
+            if attempt == attempts - 1:
+                raise
+
+            log.warning(f"HTTP {method} {host} failed: {excp}. Retry {attempt + 1}/{MAX_RETRIES}")
+
+        with _lock:
+            _stats[host]["retries"] += 1
+
+        time.sleep(get_backoff(attempt, response))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request("HEAD", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_stats():
+    """
+    Per host counters: requests sent, connections opened, connections reused and retries
+    """
+    stats = {}
+    with _lock:
+        for host, session in _sessions.items():
+            num_requests = 0
+            num_connections = 0
+            adapter = session.get_adapter("https://")
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        num_requests += pool.num_requests
+                        num_connections += pool.num_connections
+
+            stats[host] = {
+                "requests": _stats[host]["requests"],
+                "connections": num_connections,
+                "reused_connections": max(0, num_requests - num_connections),
+                "retries": _stats[host]["retries"]
+            }
+
+    return stats
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def log_stats():
+    for host, host_stats in get_stats().items():
+        log.info(f'HTTP {host}: {host_stats["requests"]} requests - {host_stats["connections"]} connections - {host_stats["reused_connections"]} reused - {host_stats["retries"]} retries')
+#----------------------------------------------------------------------------------------------------------------------------------
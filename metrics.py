@@ -0,0 +1,241 @@
+"""
+SiliconLife Eyeflow
+In-process metrics registry with Prometheus text output
+
+Counters, gauges and histograms are kept in memory and only formatted when scraped from the local
+HTTP endpoint (long running services) or dumped to <textfile_dir>/<job>.prom at the end of the
+timer-driven runs, for the node_exporter textfile collector.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from eyeflow_sdk.log_obj import CONFIG, log
+
+metrics_conf = CONFIG.get("metrics", {})
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+_registry = {}
+_registry_lock = threading.Lock()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render_values(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"] + self.render_values()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_to_current_time(self, **labels):
+        self.set(time.time(), **labels)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+
+            entry = self.values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][idx] += 1
+
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start_time, **labels)
+
+    def render_values(self):
+        lines = []
+        with self.lock:
+            for key, entry in self.values.items():
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, ('le', bound))} {count}")
+
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, ('le', '+Inf'))} {entry['count']}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {entry['count']}")
+
+        return lines
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_metric(metric_class, name, documentation, labelnames=(), **kwargs):
+    """
+    Return the metric registered with name, creating it on the first call
+    """
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = metric_class(name, documentation, labelnames, **kwargs)
+
+        return _registry[name]
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def counter(name, documentation, labelnames=()):
+    return get_metric(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return get_metric(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return get_metric(Histogram, name, documentation, labelnames, buckets=buckets)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def render():
+    """
+    All the metrics in the Prometheus text format
+    """
+    with _registry_lock:
+        metric_list = list(_registry.values())
+
+    lines = []
+    for metric in metric_list:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def start_http_server(port=None, addr=None):
+    """
+    Serve /metrics in a background thread. Returns the server, or None when the port is not set
+    """
+    port = metrics_conf.get("port") if port is None else port
+    addr = metrics_conf.get("addr", "127.0.0.1") if addr is None else addr
+    if not port:
+        return None
+
+    try:
+        server = MetricsServer((addr, int(port)), MetricsHandler)
+    except OSError as excp:
+        log.error(f"Fail starting metrics server at {addr}:{port} - {excp}")
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Metrics server at http://{addr}:{port}/metrics")
+    return server
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def write_textfile(job):
+    """
+    Dump the metrics to <textfile_dir>/<job>.prom, replacing the previous run
+    """
+    textfile_dir = metrics_conf.get("textfile_dir")
+    if not textfile_dir:
+        return
+
+    try:
+        os.makedirs(textfile_dir, exist_ok=True)
+        filename = os.path.join(textfile_dir, f"{job}.prom")
+        with open(filename + ".tmp", "w") as fp:
+            fp.write(render())
+
+        os.replace(filename + ".tmp", filename)
+    except Exception as excp:
+        log.error(f"Fail writing metrics textfile - {excp}")
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,380 @@
+"""
+SiliconLife Eyeflow
+Version constraints and dependency resolution of the edge packs
+
+The dependencies of a pack document ({pack_name: {"min", "max", "pack_id"}}) are parsed once into
+version tuples, with '*' and the edge_sdk_libs 2.x remap handled here. The older legacy remaps are only
+applied to the dependencies written in the manifest. solve() picks one version of each pack of the flow,
+newest first, so that the constraints of all the packs hold together with the installed base packs,
+going back to older versions on a conflict.
+"""
+
+import re
+import datetime
+import functools
+
+from eyeflow_sdk.log_obj import log
+
+VERSION_LEVELS = 3
+ANY = float("inf")
+MAX_STEPS = 100000
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(version, upper=False):
+    """
+    '1.2.3' -> (1, 2, 3). Missing levels and '*' are 0, or ANY for the upper bound of a constraint
+    """
+    parts = str(version).split(".")
+    levels = []
+    for level in range(VERSION_LEVELS):
+        part = parts[level].strip() if level < len(parts) else "*"
+        match = re.match(r"\d+", part)
+        if part == "*" or not match:
+            levels.append(ANY if upper else 0)
+        else:
+            levels.append(int(match.group(0)))
+
+    return tuple(levels)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remap_constraint(name, min_version, max_version):
+    """
+    edge_sdk_libs constraints of the 2.x scheme, checked against the 24.x/25.x versions
+    """
+    if name == "edge_sdk_libs" and min_version.split(".")[0] == "2":
+        min_parts = min_version.split(".")
+        max_parts = max_version.split(".")
+        min_parts[:2] = ["24", "*"]
+        max_parts[:2] = ["25", "*"]
+        return ".".join(min_parts), ".".join(max_parts)
+
+    return min_version, max_version
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remap_manifest_constraint(name, min_version, max_version):
+    """
+    Constraints of packs published before the current version schemes, rewritten in the manifest only
+    """
+    if name == "edge_sdk_libs" and min_version == "24.01.28":
+        return "1.0.0", "1.*"
+
+    if name == "eyeflow_edge" and max_version == "0.9.63":
+        return min_version, "0.9.*"
+
+    return min_version, max_version
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=None)
+def parse_constraint(name, min_version, max_version):
+    """
+    (lowest, highest) version tuples accepted by a dependency
+    """
+    min_version, max_version = remap_constraint(name, min_version, max_version)
+    return parse_version(min_version), parse_version(max_version, upper=True)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_constraint(name, dependency):
+    return parse_constraint(name, str(dependency.get("min", "*")), str(dependency.get("max", "*")))
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remap_dependencies(dependencies):
+    """
+    Copy of the dependencies of a pack document with the legacy constraints remapped, for the manifest
+    """
+    remapped = {}
+    for name, dependency in dependencies.items():
+        remapped[name] = dict(dependency)
+        min_version, max_version = remap_manifest_constraint(name, dependency.get("min"), dependency.get("max"))
+        if (min_version, max_version) != (dependency.get("min"), dependency.get("max")):
+            remapped[name]["min"], remapped[name]["max"] = min_version, max_version
+
+    return remapped
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=None)
+def parse_date(date):
+    try:
+        parsed = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f%z")
+    except (TypeError, ValueError):
+        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+
+    return parsed
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_installed_versions(packs):
+    """
+    {pack_name: version} of the edge manifest
+    """
+    return {pack["info"]["name"]: pack["info"]["version"] for pack in packs.values()}
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def check_dependencies(dependencies, installed):
+    """
+    The dependencies not met by the installed versions, as {"pack_name", "pack_id", "version"} with the min version
+    """
+    dep_list = []
+    for name, dependency in dependencies.items():
+        low, high = get_constraint(name, dependency)
+        if name not in installed or not low <= parse_version(installed[name]) <= high:
+            dep_list.append({
+                "pack_name": name,
+                "pack_id": dependency.get("pack_id", ""),
+                "version": dependency.get("min")
+            })
+
+    return dep_list
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_candidates(pack_doc):
+    """
+    Versions of a cloud pack document to try, newest first: the current version and then the version_list by date.
+    Only the versions with 'dependencies' are valid.
+    """
+    candidates = []
+    if "dependencies" in pack_doc:
+        candidates.append({"version": pack_doc["version"], "dependencies": pack_doc["dependencies"]})
+
+    version_list = [version for version in pack_doc.get("version_list", []) if "dependencies" in version]
+    for version in sorted(version_list, key=lambda x: parse_date(x.get("date")), reverse=True):
+        if version["version"] not in [candidate["version"] for candidate in candidates]:
+            candidates.append({"version": version["version"], "dependencies": version["dependencies"]})
+
+    return candidates
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_solve_order(roots):
+    """
+    Packs of roots with the packs they depend on first (post-order of the dependencies of all their candidates)
+    """
+    order = []
+    visited = set()
+    for root in roots:
+        if root in visited:
+            continue
+
+        visited.add(root)
+        stack = [(root, iter(get_root_deps(roots, root)))]
+        while stack:
+            name, deps = stack[-1]
+            for dep_name in deps:
+                if dep_name not in visited:
+                    visited.add(dep_name)
+                    stack.append((dep_name, iter(get_root_deps(roots, dep_name))))
+                    break
+            else:
+                stack.pop()
+                order.append(name)
+
+    return order
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_root_deps(roots, name):
+    deps = []
+    for candidate in roots[name]:
+        for dep_name in candidate["dependencies"]:
+            if dep_name in roots and dep_name != name and dep_name not in deps:
+                deps.append(dep_name)
+
+    return deps
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class StepLimit(Exception):
+    pass
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def solve(roots, installed, pack_ids=None, allow_install=False, max_steps=MAX_STEPS):
+    """
+    Choose a version of each pack of roots ({pack_name: candidates, newest first}) so that all the
+    dependencies hold together. A dependency on a pack outside roots is met by the installed version or,
+    with allow_install, by installing its min version. A pack with no consistent version is left out (None).
+
+    Returns {"versions": {pack_name: version}, "dependencies": {pack_name: [dependency names]},
+    "install": [{"pack_name", "pack_id", "version"}], "steps": n}
+    """
+    pack_ids = pack_ids or {}
+    # a pack is chosen after the packs it depends on, so a conflict is found where it starts
+    names = get_solve_order(roots)
+    options = []
+    for name in names:
+        name_options = []
+        for candidate in roots[name]:
+            deps = []
+            for dep_name, dependency in candidate["dependencies"].items():
+                low, high = get_constraint(dep_name, dependency)
+                deps.append((dep_name, low, high, dependency.get("min"), dependency.get("pack_id", "")))
+
+            name_options.append((candidate["version"], parse_version(candidate["version"]), deps))
+
+        options.append(name_options + [None])
+
+    chosen = {}
+    posted = {}
+    bounds = {}
+
+    def get_bounds(name, extra=None):
+        """
+        Intersection (low, high, min_version, pack_id) of the constraints posted on name, with extra
+        """
+        current = bounds[name][-1] if bounds.get(name) else None
+        if extra is None:
+            return current
+
+        if current is None:
+            return extra
+
+        low, high, min_version, pack_id = current
+        if extra[0] > low:
+            low, min_version, pack_id = extra[0], extra[2], extra[3]
+
+        return low, min(high, extra[1]), min_version, pack_id
+
+    def post(name, constraint):
+        bounds.setdefault(name, []).append(get_bounds(name, constraint))
+        posted.setdefault(name, []).append(constraint)
+
+    def unpost(name, constraint):
+        if posted[name][-1] == constraint:
+            posted[name].pop()
+            bounds[name].pop()
+        else:
+            posted[name].remove(constraint)
+            bounds[name] = []
+            for other in posted[name]:
+                bounds[name].append(get_bounds(name, other))
+
+    def external_ok(name, name_bounds):
+        if name_bounds is None:
+            return True
+
+        low, high, _, _ = name_bounds
+        if name in installed and low <= parse_version(installed[name]) <= high:
+            return True
+
+        # installing the highest min version of the constraints
+        return allow_install and low <= high
+
+    def consistent(name, option):
+        if option is None:
+            return external_ok(name, get_bounds(name))
+
+        version_str, version, deps = option
+        name_bounds = get_bounds(name)
+        if name_bounds is not None and not name_bounds[0] <= version <= name_bounds[1]:
+            return False
+
+        for dep_name, low, high, min_version, pack_id in deps:
+            if dep_name == name or (dep_name in roots and dep_name not in chosen):
+                continue
+
+            if chosen.get(dep_name) is not None:
+                if not low <= chosen[dep_name][1] <= high:
+                    return False
+            elif not external_ok(dep_name, get_bounds(dep_name, (low, high, min_version, pack_id))):
+                return False
+
+        return True
+
+    def apply(name, option):
+        chosen[name] = option
+        if option is not None:
+            for dep_name, low, high, min_version, pack_id in option[2]:
+                if dep_name != name:
+                    post(dep_name, (low, high, min_version, pack_id))
+
+    def undo(name):
+        option = chosen.pop(name)
+        if option is not None:
+            for dep_name, low, high, min_version, pack_id in option[2]:
+                if dep_name != name:
+                    unpost(dep_name, (low, high, min_version, pack_id))
+
+    steps = 0
+    try:
+        # backtracking over the packs, the last option of each pack is to leave it out
+        positions = [0] * len(names)
+        idx = 0
+        while idx < len(names):
+            name = names[idx]
+            if positions[idx] > 0:
+                undo(name)
+
+            while positions[idx] < len(options[idx]):
+                option = options[idx][positions[idx]]
+                positions[idx] += 1
+                steps += 1
+                if steps > max_steps:
+                    raise StepLimit()
+
+                if consistent(name, option):
+                    apply(name, option)
+                    break
+            else:
+                positions[idx] = 0
+                idx -= 1
+                continue
+
+            idx += 1
+            if idx < len(names):
+                positions[idx] = 0
+    except StepLimit:
+        log.warning(f"Dependency resolution stopped after {max_steps} steps, choosing the versions pack by pack")
+        chosen.clear()
+        posted.clear()
+        bounds.clear()
+        for idx, name in enumerate(names):
+            for option in options[idx]:
+                if option is None or consistent(name, option):
+                    apply(name, option)
+                    break
+
+        # the packs left out may break the ones chosen before them
+        changed = True
+        while changed:
+            changed = False
+            for name in names:
+                option = chosen[name]
+                if option is not None:
+                    undo(name)
+                    if consistent(name, option):
+                        apply(name, option)
+                    else:
+                        apply(name, None)
+                        changed = True
+
+    install = []
+    for name in posted:
+        name_bounds = get_bounds(name)
+        if name_bounds is None or chosen.get(name) is not None:
+            continue
+
+        low, high, min_version, pack_id = name_bounds
+        if name in installed and low <= parse_version(installed[name]) <= high:
+            continue
+
+        install.append({"pack_name": name, "pack_id": pack_id or pack_ids.get(name, ""), "version": min_version})
+
+    return {
+        "versions": {name: option[0] if option is not None else None for name, option in chosen.items()},
+        "dependencies": {name: [dep[0] for dep in option[2]] if option is not None else [] for name, option in chosen.items()},
+        "install": install,
+        "steps": steps
+    }
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -3,6 +3,21 @@
 export LD_LIBRARY_PATH=/opt/eyeflow/lib:/usr/local/cuda/lib64:$LD_LIBRARY_PATH
 export CUDA_MODULE_LOADING=LAZY
 
+# standby containers wait here until the endpoint agent binds them to an endpoint.
+# eyeflow_edge needs the license and cloud_sync/prepare_models need the endpoint, so the runtime
+# (CUDA, models) only starts after the bind: the wait only reads the runtime files into the page cache
+if [ ! -f edge.license ]; then
+    cat ./eyeflow_edge /opt/eyeflow/lib/* > /dev/null 2>&1
+fi
+
+while [ ! -f edge.license ]; do
+    sleep 0.2
+done
+
+if [ -f endpoint.env ]; then
+    . ./endpoint.env
+fi
+
 python3 cloud_sync.py
 python3 prepare_models.py
 ./eyeflow_edge --endpoint
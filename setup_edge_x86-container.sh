@@ -106,6 +106,7 @@ then
   mkdir -p /opt/eyeflow/log
   mkdir -p /opt/eyeflow/run
   mkdir -p /opt/eyeflow/components
+  mkdir -p /opt/eyeflow/blobs
   mkdir -p /opt/eyeflow/install
 fi
 
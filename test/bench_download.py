@@ -0,0 +1,110 @@
+"""
+Throughput check of utils.download_file single stream vs segmented download
+against a local HTTP server that limits the bandwidth of each connection.
+
+Usage: python3 test/bench_download.py [size_mb] [segments]
+"""
+
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import utils
+
+
+CONNECTION_RATE = 4 * 1024 * 1024  # bytes/sec for each connection
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        file_size = os.path.getsize(path)
+        start, end = 0, file_size - 1
+        range_header = self.headers.get("Range")
+        if range_header and self.server.support_ranges:
+            start, end = range_header.replace("bytes=", "").split("-")
+            start = int(start)
+            end = int(end) if end else file_size - 1
+            if start >= file_size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{file_size}")
+                self.end_headers()
+                return
+
+            end = min(end, file_size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fp.read(min(remaining, CONNECTION_RATE // 10))
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+
+                remaining -= len(chunk)
+                time.sleep(len(chunk) / CONNECTION_RATE)
+
+
+def start_server(folder, support_ranges=True):
+    handler = lambda *args, **kwargs: RangeHandler(*args, directory=folder, **kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.support_ranges = support_ranges
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_download(url, dest_file, file_hash, segments):
+    if os.path.isfile(dest_file):
+        os.remove(dest_file)
+
+    start = time.time()
+    report = utils.download_file(url, dest_file, file_hash=file_hash, segments=segments)
+    elapsed = time.time() - start
+    print(f"segments: {segments} - {report['size'] / elapsed / (1024 * 1024):.1f} MB/s - {elapsed:.2f}s")
+    return elapsed
+
+
+def main(size_mb, segments):
+    with tempfile.TemporaryDirectory() as folder:
+        data = os.urandom(size_mb * 1024 * 1024)
+        with open(os.path.join(folder, "model.tar.gz"), "wb") as fp:
+            fp.write(data)
+
+        file_hash = "sha256:" + hashlib.sha256(data).hexdigest()
+        dest_file = os.path.join(folder, "down", "model.tar.gz")
+
+        server = start_server(folder)
+        url = f"http://127.0.0.1:{server.server_address[1]}/model.tar.gz"
+        single_time = run_download(url, dest_file, file_hash, segments=1)
+        segmented_time = run_download(url, dest_file, file_hash, segments=segments)
+        server.shutdown()
+        print(f"speedup: {single_time / segmented_time:.1f}x")
+
+        # server without range support must fall back to a single stream
+        server = start_server(folder, support_ranges=False)
+        url = f"http://127.0.0.1:{server.server_address[1]}/model.tar.gz"
+        run_download(url, dest_file, file_hash, segments=segments)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    segments = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    main(size_mb, segments)
@@ -0,0 +1,207 @@
+"""
+Timing and consistency check of pack_resolver.solve on synthetic manifests, against the previous
+selection pack by pack (manifest read and version_list sorted with strptime for every pack).
+
+Usage: python3 test/bench_pack_resolver.py [num_packs] [versions_per_pack]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import pack_resolver
+
+
+BASE_VERSIONS = {"eyeflow_edge": "0.9.40", "edge_sdk_libs": "1.4.0", "libedge_sdk": "4.2.0"}
+
+
+def make_manifest():
+    packs = {}
+    for idx, (name, version) in enumerate(BASE_VERSIONS.items()):
+        packs[f"base{idx}"] = {"info": {"name": name, "version": version, "date": "2024-01-01 00:00:00"}, "dependencies": []}
+
+    return packs
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def make_pack_docs(num_packs, versions_per_pack, seed=1):
+    """
+    Component docs with a version_list. Each version depends on the base packs, the newest ones on
+    versions not installed yet, and some packs on other packs of the flow.
+    """
+    rnd = random.Random(seed)
+    start_date = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    docs = []
+    for idx in range(num_packs):
+        version_list = []
+        for ver in range(versions_per_pack):
+            dependencies = {
+                "eyeflow_edge": {"min": f"0.9.{ver * 5}", "max": "0.9.*"},
+                "edge_sdk_libs": {"min": "1.0.0" if ver % 3 else "24.01.28", "max": "1.*"},
+            }
+            if idx > 0 and rnd.random() < 0.2:
+                dep_idx = rnd.randrange(idx)
+                dependencies[f"comp{dep_idx}"] = {"min": f"1.{rnd.randrange(versions_per_pack // 2 + 1)}.0", "max": "1.*"}
+
+            date = start_date + datetime.timedelta(days=ver * 30 + rnd.randrange(10))
+            version_list.append({"version": f"1.{ver}.0", "date": date.strftime("%Y-%m-%dT%H:%M:%S.%f%z"), "dependencies": dependencies})
+
+        rnd.shuffle(version_list)
+        latest = max(version_list, key=lambda version: int(version["version"].split(".")[1]))
+        docs.append({
+            "pack_id": f"id{idx}",
+            "pack_name": f"comp{idx}",
+            "version": latest["version"],
+            "dependencies": latest["dependencies"],
+            "version_list": version_list
+        })
+
+    return docs
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def legacy_check(dependencies, packs, pack_names):
+    dep_list = []
+    for dep in dependencies:
+        if dep not in pack_names:
+            dep_list.append(dep)
+            continue
+
+        dep_ver_min = dependencies[dep]["min"].split(".")
+        dep_ver_max = dependencies[dep]["max"].split(".")
+        pack_version = packs[pack_names[dep]]["info"]["version"].split(".")
+        pack_ver_int = dep_ver_min_int = dep_ver_max_int = 0
+        for level in range(3):
+            dep_ver_min_int = dep_ver_min_int * 1000 + (0 if level >= len(dep_ver_min) or dep_ver_min[level] == "*" else int(dep_ver_min[level]))
+            dep_ver_max_int = dep_ver_max_int * 1000 + (999 if level >= len(dep_ver_max) or dep_ver_max[level] == "*" else int(dep_ver_max[level]))
+            pack_ver_int = pack_ver_int * 1000 + (0 if level >= len(pack_version) else int(pack_version[level]))
+
+        if pack_ver_int < dep_ver_min_int or pack_ver_int > dep_ver_max_int:
+            dep_list.append(dep)
+            break
+
+    return dep_list
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def legacy_select(pack_doc, manifest_filename):
+    with open(manifest_filename) as fp:
+        packs = json.load(fp)
+
+    pack_names = {packs[pack_id]["info"]["name"]: pack_id for pack_id in packs}
+    if not legacy_check(pack_doc["dependencies"], packs, pack_names):
+        return pack_doc["version"]
+
+    version_list = sorted(pack_doc["version_list"], key=lambda x: datetime.datetime.strptime(x["date"], "%Y-%m-%dT%H:%M:%S.%f%z"), reverse=True)
+    for version in version_list:
+        if not legacy_check(version["dependencies"], packs, pack_names):
+            return version["version"]
+
+    return None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def check_solution(docs, installed, solution):
+    """
+    Number of dependencies broken by the chosen versions
+    """
+    versions = dict(installed)
+    versions.update({dep["pack_name"]: dep["version"] for dep in solution["install"]})
+    versions.update({name: version for name, version in solution["versions"].items() if version is not None})
+    broken = 0
+    for doc in docs:
+        version = solution["versions"].get(doc["pack_name"])
+        if version is None:
+            continue
+
+        candidate = [candidate for candidate in pack_resolver.get_candidates(doc) if candidate["version"] == version][0]
+        for name, dependency in candidate["dependencies"].items():
+            low, high = pack_resolver.get_constraint(name, dependency)
+            if name not in versions or not low <= pack_resolver.parse_version(versions[name]) <= high:
+                broken += 1
+
+    return broken
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def run(num_packs, versions_per_pack):
+    packs = make_manifest()
+    docs = make_pack_docs(num_packs, versions_per_pack)
+    installed = pack_resolver.get_installed_versions(packs)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_filename = os.path.join(tmp_dir, "edge_manifest.json")
+        with open(manifest_filename, "w") as fp:
+            json.dump(packs, fp)
+
+        start_time = time.time()
+        legacy_versions = {doc["pack_name"]: legacy_select(doc, manifest_filename) for doc in docs}
+        legacy_time = time.time() - start_time
+
+    for allow_install in [False, True]:
+        pack_resolver.parse_version.cache_clear()
+        pack_resolver.parse_constraint.cache_clear()
+        pack_resolver.parse_date.cache_clear()
+        start_time = time.time()
+        roots = {doc["pack_name"]: pack_resolver.get_candidates(doc) for doc in docs}
+        solution = pack_resolver.solve(roots, installed, allow_install=allow_install)
+        solve_time = time.time() - start_time
+
+        resolved = len([version for version in solution["versions"].values() if version is not None])
+        print(
+            f"solve allow_install={allow_install}: {solve_time * 1000:.1f} ms - {solution['steps']} steps - "
+            f"{resolved}/{len(docs)} packs - installs: {[(dep['pack_name'], dep['version']) for dep in solution['install']]} - "
+            f"broken dependencies: {check_solution(docs, installed, solution)}"
+        )
+
+    legacy_solution = {"versions": legacy_versions, "install": []}
+    legacy_resolved = len([version for version in legacy_versions.values() if version is not None])
+    print(
+        f"legacy pack by pack: {legacy_time * 1000:.1f} ms - {legacy_resolved}/{len(docs)} packs - "
+        f"broken dependencies: {check_solution(docs, installed, legacy_solution)}"
+    )
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def run_conflict(depth):
+    """
+    A chain of packs where the newest version of each one conflicts with the next, so the solver has to go back
+    """
+    docs = []
+    for idx in range(depth):
+        version_list = []
+        for ver in range(3):
+            dependencies = {"eyeflow_edge": {"min": "0.9.0", "max": "0.9.*"}}
+            if idx + 1 < depth:
+                dependencies[f"chain{idx + 1}"] = {"min": f"1.{ver}.0", "max": "1.*"}
+
+            version_list.append({"version": f"1.{ver}.0", "date": f"2024-0{ver + 1}-01T00:00:00.000+0000", "dependencies": dependencies})
+
+        docs.append({"pack_id": f"chain{idx}", "pack_name": f"chain{idx}", "version": "1.2.0", "dependencies": version_list[2]["dependencies"], "version_list": version_list})
+
+    # the last pack of the chain only has its oldest version
+    docs[-1]["version_list"] = docs[-1]["version_list"][:1]
+    docs[-1]["version"] = "1.0.0"
+    docs[-1]["dependencies"] = docs[-1]["version_list"][0]["dependencies"]
+
+    installed = pack_resolver.get_installed_versions(make_manifest())
+    start_time = time.time()
+    roots = {doc["pack_name"]: pack_resolver.get_candidates(doc) for doc in docs}
+    solution = pack_resolver.solve(roots, installed)
+    print(
+        f"conflict chain of {depth}: {(time.time() - start_time) * 1000:.1f} ms - {solution['steps']} steps - "
+        f"versions: {sorted(set(solution['versions'].values()))} - broken dependencies: {check_solution(docs, installed, solution)}"
+    )
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    num_packs = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    versions_per_pack = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    run(num_packs, versions_per_pack)
+    run_conflict(50)
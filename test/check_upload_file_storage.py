@@ -0,0 +1,139 @@
+"""
+Check of the chunked, resumable upload of upload_file_storage against a local stand-in server
+implementing the upload-session part endpoints. The first run drops the connection on some parts,
+the second run must resume sending only the missing parts.
+
+Usage: python3 test/check_upload_file_storage.py [size_mb]
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import threading
+import importlib.util
+from importlib.machinery import SourceFileLoader
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import jwt
+
+install_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.append(install_folder)
+loader = SourceFileLoader("upload_file_storage", os.path.join(install_folder, "upload_file_storage"))
+spec = importlib.util.spec_from_loader("upload_file_storage", loader)
+upload_file_storage = importlib.util.module_from_spec(spec)
+loader.exec_module(upload_file_storage)
+
+
+class UploadServer(ThreadingHTTPServer):
+    def __init__(self, fail_parts):
+        super().__init__(("127.0.0.1", 0), UploadHandler)
+        self.sessions = {}
+        self.fail_parts = set(fail_parts)
+        self.received_parts = []
+        self.lock = threading.Lock()
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        path = self.path.split("/")
+        body = json.loads(self.read_body() or b"{}")
+        if path[-1] == "upload-session":
+            upload_id = f"upload{len(self.server.sessions)}"
+            self.server.sessions[upload_id] = {"info": body, "parts": {}}
+            self.send_json(201, {"upload_id": upload_id})
+        elif path[-1] == "complete":
+            session = self.server.sessions[path[-2]]
+            session["data"] = b"".join(session["parts"][part["part"]] for part in body["parts"])
+            self.send_json(201, {"size": len(session["data"])})
+        else:
+            self.send_json(404, {})
+
+    def do_GET(self):
+        session = self.server.sessions.get(self.path.split("/")[-1])
+        if session is None:
+            self.send_json(404, {})
+            return
+
+        self.send_json(200, {"parts": list(session["parts"])})
+
+    def do_PUT(self):
+        path = self.path.split("/")
+        part_number = int(path[-1])
+        data = self.read_body()
+        with self.server.lock:
+            if part_number in self.server.fail_parts:
+                self.server.fail_parts.discard(part_number)
+                self.close_connection = True
+                self.send_json(503, {})
+                return
+
+            self.server.received_parts.append(part_number)
+
+        if self.headers["X-Part-Checksum"] != "sha256:" + hashlib.sha256(data).hexdigest():
+            self.send_json(400, {})
+            return
+
+        self.server.sessions[path[-3]]["parts"][part_number] = data
+        self.send_json(200, {"etag": hashlib.md5(data).hexdigest()})
+
+
+def main(size_mb):
+    upload_file_storage.upload_conf["part_size"] = 1024 * 1024
+    upload_file_storage.http_client.MAX_RETRIES = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        upload_file_storage.CONFIG["file-service"]["temp_folder"] = folder
+        local_filename = os.path.join(folder, "video.mp4")
+        data = os.urandom(size_mb * 1024 * 1024 + 123)
+        with open(local_filename, "wb") as fp:
+            fp.write(data)
+
+        server = UploadServer(fail_parts=[1, 3])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        app_token = jwt.encode({"endpoint": f"http://127.0.0.1:{server.server_address[1]}"}, "key", algorithm="HS256")
+        app_info = {"edge_id": "edge"}
+
+        try:
+            upload_file_storage.upload_file_parts(app_token, app_info, local_filename)
+        except Exception as excp:
+            print(f"First run interrupted: {excp}")
+        else:
+            raise AssertionError("First upload should fail")
+
+        with open(upload_file_storage.get_upload_state_file(local_filename)) as fp:
+            acknowledged = set(int(part) for part in json.load(fp)["parts"])
+
+        first_run_parts = len(server.received_parts)
+        upload_file_storage.upload_file_parts(app_token, app_info, local_filename)
+        resent = server.received_parts[first_run_parts:]
+        print(f"First run acknowledged parts: {sorted(acknowledged)} - second run sent parts: {sorted(resent)}")
+
+        session = server.sessions["upload0"]
+        assert session["data"] == data, "Uploaded data differs"
+        assert {1, 3} <= set(resent), "Resume did not send the failed parts"
+        assert not acknowledged & set(resent), "Resume sent parts already acknowledged"
+        assert not os.path.isfile(upload_file_storage.get_upload_state_file(local_filename)), "Upload state not removed"
+        server.shutdown()
+        print("Chunked upload OK")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
@@ -12,6 +12,9 @@ import traceback
 import sys
 import argparse
 import json
+import shutil
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from eyeflow_sdk import edge_client
 from eyeflow_sdk.log_obj import CONFIG, log
 
@@ -22,6 +25,9 @@ if "proxies" in CONFIG:
     proxies = CONFIG["proxies"]
 
 import utils
+import extract_index
+
+REMAP_BATCH_SIZE = 256
 #----------------------------------------------------------------------------------------------------------------------------------
 
 def get_dataset_folder(dataset):
@@ -29,16 +35,11 @@ def get_dataset_folder(dataset):
     if os.path.isdir(dataset_folder):
         return dataset_folder, dataset
 
-    for dset in os.listdir(CONFIG["file-service"]["model"]):
-        dataset_folder = os.path.join(CONFIG["file-service"]["model"], dset)
-        if os.path.isfile(os.path.join(dataset_folder, dset + ".json")):
-            with open(os.path.join(dataset_folder, dset + ".json")) as fp:
-                dset_data = json.load(fp)
-
-            if dset_data["name"] == dataset or dset_data["info"]["long_name"] == dataset:
-                dataset_folder = os.path.join(CONFIG["file-service"]["extract"], dset_data["_id"])
-                if os.path.isdir(dataset_folder):
-                    return dataset_folder, dset_data["_id"]
+    # several datasets can have the name: the one with extracts
+    for dataset_id in extract_index.find_datasets(dataset):
+        dataset_folder = os.path.join(CONFIG["file-service"]["extract"], dataset_id)
+        if os.path.isdir(dataset_folder):
+            return dataset_folder, dataset_id
 
     raise Exception(f"Dataset not found: {dataset}")
 #----------------------------------------------------------------------------------------------------------------------------------
@@ -49,11 +50,78 @@ def parse_args(args):
     parser = argparse.ArgumentParser(description='Upload flow extracts.')
     parser.add_argument('-d', '--dataset', help='The ID/Name of dataset to upload', type=str)
     parser.add_argument('-dd', '--ddataset', help='The ID/Name of dataset destination to upload from source dataset', type=str)
+    parser.add_argument('--dry_run', help='Only report how many instances would be remapped to the destination classes', action='store_true')
+    parser.add_argument('--workers', help='Number of processes rewriting the _data.json files', type=int, default=os.cpu_count())
+    parser.add_argument('--only_class', help='Upload only the extracts with an instance of this class label', type=str)
+    parser.add_argument('--since', help='Upload only the extracts written since this date (YYYY-MM-DD)', type=datetime.datetime.fromisoformat)
+    parser.add_argument('--counts', help='Show the number of extracts of each class label and exit', action='store_true')
 
     return parser.parse_args(args)
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
+def remap_extract_data(source_file_path, destination_file_path, class_map, dry_run=False):
+    """
+    Set the class of the annotation instances from the label, using the destination class_map.
+    Returns the number of instances remapped. Runs in the process pool.
+    """
+    with open(source_file_path, 'r') as f:
+        extract_data = json.load(f)
+
+    remapped = 0
+    for instance in extract_data.get("annotations", {}).get("instances", []):
+        label = instance.get("label")
+        if label in class_map and instance.get("class") != class_map[label]:
+            instance["class"] = class_map[label]
+            remapped += 1
+
+    if not dry_run:
+        with open(destination_file_path, 'w') as f:
+            json.dump(extract_data, f, separators=(',', ':'))
+
+    return remapped
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remap_extract_batch(extracts, extract_path, destination_extract_path, class_map, dry_run=False):
+    """
+    remap_extract_data for a batch of extracts, so that a task of the process pool is not a single small file.
+    Returns [(extract, remapped, error)]. Runs in the process pool.
+    """
+    results = []
+    for extract in extracts:
+        try:
+            remapped = remap_extract_data(
+                os.path.join(extract_path, extract),
+                os.path.join(destination_extract_path, extract),
+                class_map,
+                dry_run
+            )
+            results.append((extract, remapped, None))
+        except Exception as excp:
+            results.append((extract, 0, str(excp)))
+
+    return results
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def link_extract_file(source_file_path, destination_file_path):
+    """
+    Hardlink the file to the destination, copying when they are not on the same filesystem
+    """
+    if os.path.lexists(destination_file_path):
+        if os.path.samefile(source_file_path, destination_file_path):
+            return
+
+        os.remove(destination_file_path)
+
+    try:
+        os.link(source_file_path, destination_file_path)
+    except OSError:
+        shutil.copy2(source_file_path, destination_file_path)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
 def map_and_update_extract_classes(args, app_token):
     """
     Copy all extracts from source dataset to destination dataset,
@@ -66,54 +134,82 @@ def map_and_update_extract_classes(args, app_token):
     destination_dataset.load_data()
 
     extract_path, dataset_id = get_dataset_folder(args.dataset)
-    os.makedirs(os.path.join(CONFIG["file-service"]["extract"], args.ddataset), exist_ok=True)
     destination_extract_path = os.path.join(CONFIG["file-service"]["extract"], args.ddataset)
-    
-    log.info(f"Copying extracts from {extract_path} to {destination_extract_path}")
+    if not args.dry_run:
+        os.makedirs(destination_extract_path, exist_ok=True)
+
+    log.info(f"{'Checking' if args.dry_run else 'Copying'} extracts from {extract_path} to {destination_extract_path}")
+
+    # the last destination class with the label wins, as when the classes were scanned for each instance
+    class_map = {}
+    for parms in destination_dataset.parms.get("classes", []):
+        class_map[parms.get("label")] = parms["name"]
+
+    json_files = []
+    other_files = []
+    with os.scandir(extract_path) as it:
+        for entry in it:
+            if entry.name.endswith("_data.json"):
+                json_files.append(entry.name)
+            elif entry.is_file():
+                other_files.append(entry.name)
 
-    destination_parms = destination_dataset.parms.get("classes", [])
-    extracts = os.listdir(extract_path)
-    
     files_processed = 0
     files_modified = 0
+    instances_remapped = 0
+    errors = 0
+
+    # about 4 batches for each worker, so that the workers stay busy until the end
+    batch_size = max(1, min(REMAP_BATCH_SIZE, len(json_files) // (max(1, args.workers) * 4)))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                remap_extract_batch,
+                json_files[idx:idx + batch_size],
+                extract_path,
+                destination_extract_path,
+                class_map,
+                args.dry_run
+            ): json_files[idx:idx + batch_size] for idx in range(0, len(json_files), batch_size)
+        }
+
+        # images and thumbnails are linked while the JSON files are rewritten
+        if not args.dry_run:
+            for extract in other_files:
+                try:
+                    link_extract_file(os.path.join(extract_path, extract), os.path.join(destination_extract_path, extract))
+                    files_processed += 1
+                except Exception as e:
+                    errors += 1
+                    log.error(f"Error processing {extract}: {e}")
+
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                errors += len(futures[future])
+                log.error(f"Error processing {futures[future][0]} and {len(futures[future]) - 1} more extracts: {e}")
+                continue
+
+            for extract, remapped, error in results:
+                if error is not None:
+                    errors += 1
+                    log.error(f"Error processing {extract}: {error}")
+                    continue
+
+                instances_remapped += remapped
+                files_modified += 1 if remapped else 0
+                files_processed += 1
+
+    if args.dry_run:
+        log.info(f"Dry run: {instances_remapped} instances would be remapped in {files_modified} of {len(json_files)} JSON files")
+    else:
+        log.info(f"Completed: {files_processed} files processed, {files_modified} JSON files modified, {instances_remapped} instances remapped, {errors} errors")
 
-    for extract in extracts:
-        source_file_path = os.path.join(extract_path, extract)
-        destination_file_path = os.path.join(destination_extract_path, extract)
-
-        try:
-            if extract.endswith("_data.json"):
-                # Process and modify _data.json files
-                with open(source_file_path, 'r') as f:
-                    extract_data = json.load(f)
-                
-                if "annotations" in extract_data and "instances" in extract_data["annotations"]:
-                    for instance in extract_data["annotations"]["instances"]:
-                        for parms in destination_parms:
-                            if instance.get("label") == parms.get("label"):
-                                instance["class"] = parms["name"]
-                
-                with open(destination_file_path, 'w') as f:
-                    json.dump(extract_data, f, indent=4)
-                
-                files_modified += 1
-                log.info(f"Modified and saved: {extract}")
-                
-            else:
-                # Copy other files as-is (images, thumbnails, etc.)
-                if os.path.isfile(source_file_path):
-                    import shutil
-                    shutil.copy2(source_file_path, destination_file_path)
-                    log.debug(f"Copied: {extract}")
-            
-            files_processed += 1
-
-        except Exception as e:
-            log.error(f"Error processing {extract}: {e}")
-
-    log.info(f"Completed: {files_processed} files processed, {files_modified} JSON files modified")
     log.info(f"Source classes: {source_dataset.parms.get('classes', [])}")
     log.info(f"Destination classes: {destination_dataset.parms.get('classes', [])}")
+    return instances_remapped
+#----------------------------------------------------------------------------------------------------------------------------------
 
 
 def main(args=None):
@@ -140,33 +236,36 @@ def main(args=None):
 
     if args.dataset:
         source_extract_path, source_dataset_id = get_dataset_folder(args.dataset)
+        if args.counts:
+            for label, count in extract_index.get_class_counts(source_dataset_id).items():
+                log.info(f"{label}: {count}")
+
+            return
+
         target_dataset_id = source_dataset_id
         target_extract_path = source_extract_path
 
         if args.ddataset:
             log.info("Mapping and updating extracts for destination dataset.")
             map_and_update_extract_classes(args, app_token)
+            if args.dry_run:
+                return
+
             target_dataset_id = args.ddataset
             target_extract_path = os.path.join(CONFIG["file-service"]["extract"], args.ddataset)
         else:
             log.info("Source and destination datasets are the same.")
 
-        files_to_upload_and_delete = os.listdir(target_extract_path)
-        if not edge_client.upload_extract(
-            app_token,
-            target_dataset_id,
-            extract_folder=CONFIG["file-service"]["extract"],
-            max_files=800,
-            thumb_size=128
-        ):
+        examples = None
+        if args.only_class or args.since:
+            examples = extract_index.select_examples(target_dataset_id, only_class=args.only_class, since=args.since, limit=800)
+            log.info(f"{len(examples)} extracts selected")
+
+        result = utils.upload_dataset_extract(app_token, target_dataset_id, max_examples=800, examples=examples)
+        if result["status"] == "fail":
             log.error(f'Fail uploading extract {target_dataset_id}')
         else:
-            log.info("Deleting files from: " + target_extract_path)
-            for filename in files_to_upload_and_delete:
-                try:
-                    os.remove(os.path.join(target_extract_path, filename))
-                except Exception as e:
-                    log.error(f"Error deleting file {filename}: {e}")
+            log.info(f'Uploaded {result["files"]} files - {result["bytes"]} bytes from: {target_extract_path}')
     else:
         try:
             if host_type == "endpoint":
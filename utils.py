@@ -10,36 +10,756 @@ import datetime
 import shutil
 import subprocess
 import tarfile
+import hashlib
+import time
+import tempfile
+import signal
+import threading
+import collections
+import queue
+import fcntl
+from contextlib import contextmanager
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from eyeflow_sdk.log_obj import CONFIG, log
 from eyeflow_sdk import jetson_utils
 from eyeflow_sdk import edge_client
 
+import blob_store
+import http_client
+import metrics
+
 os.environ["CUDA_MODULE_LOADING"] = "LAZY"
 
-proxies = {}
-if "proxies" in CONFIG:
-    proxies = CONFIG["proxies"]
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_TYPES = ["sha256", "sha1", "md5"]
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PROCESS_READ_SIZE = 64 * 1024
+PROCESS_OUTPUT_HEAD = 64 * 1024
+PROCESS_OUTPUT_TAIL = 256 * 1024
+
+DOWNLOAD_BYTES = metrics.counter("eyeflow_download_bytes_total", "Bytes of the files downloaded, by source", ["source"])
+DOWNLOADS = metrics.counter("eyeflow_downloads_total", "Files downloaded, by result", ["result"])
+DOWNLOAD_SECONDS = metrics.histogram("eyeflow_download_seconds", "Duration of the file downloads")
+MODEL_UPDATES = metrics.counter("eyeflow_model_updates_total", "Model checks, by status", ["status"])
+MODEL_DATE = metrics.gauge("eyeflow_model_date_timestamp_seconds", "Train date of the local model", ["dataset_id"])
+MODEL_UPDATE_LAG = metrics.gauge("eyeflow_model_update_lag_seconds", "Time from the model train date to its download", ["dataset_id"])
 #----------------------------------------------------------------------------------------------------------------------------------
 
-def download_file(url, local_filename):
-    os.makedirs(os.path.dirname(local_filename), exist_ok=True)
-    with requests.get(url, stream=True, proxies=proxies) as r:
+def get_doc_checksum(doc):
+    """
+    Get the expected size and hash of a file from a pack/model/file document
+    """
+    file_size = None
+    for key in ["filesize", "file_size", "size"]:
+        if isinstance(doc.get(key), int) and doc[key] > 0:
+            file_size = doc[key]
+            break
+
+    file_hash = None
+    for hash_type in HASH_TYPES:
+        if doc.get(hash_type):
+            file_hash = f"{hash_type}:{doc[hash_type]}"
+            break
+    else:
+        checksum = doc.get("checksum") or doc.get("hash")
+        if isinstance(checksum, str) and ":" in checksum and checksum.split(":")[0] in HASH_TYPES:
+            file_hash = checksum
+
+    return file_size, file_hash
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_file_hash(filename, hash_type):
+    hasher = hashlib.new(hash_type)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def download_segmented(url, part_filename, segments, min_segment_size):
+    """
+    Download url in byte ranges fetched by parallel connections, writing each segment with pwrite
+    into a preallocated part_filename. Returns None when the server does not support ranges
+    or the file is too small to be split.
+    """
+    with http_client.get(url, stream=True, headers={"Range": "bytes=0-0"}) as r:
         r.raise_for_status()
+        content_range = r.headers.get("Content-Range", "")
+        if r.status_code != 206 or "/" not in content_range or content_range.endswith("/*"):
+            return None
+
+        validator = get_validator(r.headers)
+
+    total_size = int(content_range.split("/")[-1])
+    segments = min(segments, total_size // min_segment_size)
+    if segments < 2:
+        return None
+
+    segment_size = -(-total_size // segments)
+    ranges = [(start, min(start + segment_size, total_size) - 1) for start in range(0, total_size, segment_size)]
+
+    def fetch_segment(start, end):
+        offset = start
+        msg_headers = {"Range": f"bytes={start}-{end}"}
+        if validator:
+            msg_headers["If-Range"] = validator
+
+        with http_client.get(url, stream=True, headers=msg_headers) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise Exception(f"Server did not return a partial content for range {start}-{end}")
+
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            raise Exception(f"Incomplete segment {start}-{end}: received {offset - start} bytes")
+
+        return offset - start
+
+    fd = os.open(part_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, total_size)
+        except OSError:
+            os.ftruncate(fd, total_size)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch_segment, start, end) for start, end in ranges]
+            fetched = sum(future.result() for future in futures)
+    except:
+        # a preallocated file with holes can not be resumed
+        os.close(fd)
+        os.remove(part_filename)
+        raise
+
+    os.close(fd)
+    log.info(f"Segmented download: {os.path.basename(part_filename)} - {len(ranges)} segments - {total_size} bytes")
+    return fetched
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_validator(headers):
+    """
+    Value of If-Range that identifies the remote file: a strong ETag or else Last-Modified
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return headers.get("Last-Modified")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_part_meta(part_filename):
+    """
+    {"validator", "size"} of the remote file of a '.part' download, saved at the start of the download
+    """
+    try:
+        with open(part_filename + ".json") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def save_part_meta(part_filename, headers):
+    content_length = headers.get("Content-Length")
+    part_meta = {
+        "validator": get_validator(headers),
+        "size": int(content_length) if content_length and content_length.isdigit() else None
+    }
+    with open(part_filename + ".json", 'w') as fp:
+        json.dump(part_meta, fp)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def remove_part_file(part_filename):
+    for filename in [part_filename, part_filename + ".json"]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def is_same_remote_file(part_meta, headers):
+    """
+    Check a 206 response against the validator saved with the part file, for servers that ignore If-Range
+    """
+    validator = part_meta.get("validator")
+    if not validator:
+        return True
+
+    if validator == headers.get("ETag") or validator == headers.get("Last-Modified"):
+        return True
+
+    return headers.get("ETag") is None and headers.get("Last-Modified") is None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def download_file(url, local_filename, file_size=None, file_hash=None, segments=None, store_key=None, store_version=None):
+    """
+    Download url to local_filename through a '.part' file, resuming a previous partial download
+    with a HTTP Range request. The ETag (or Last-Modified) of the file is saved next to the '.part'
+    and sent as If-Range, so the part of another version of the file is discarded.
+    The file is verified against file_size and file_hash ('<hash_type>:<hex>') before being renamed to local_filename.
+    With segments > 1 (default from CONFIG["download"]["segments"]) a new download is fetched
+    by parallel ranged connections, falling back to a single stream when ranges are not supported.
+    With store_key the file is linked from the local blob store when store_key/store_version or
+    file_hash is already there, and added to the store after a download.
+    """
+    start_time = time.time()
+    try:
+        download_report = fetch_file(url, local_filename, file_size, file_hash, segments, store_key, store_version)
+    except Exception:
+        DOWNLOADS.inc(result="fail")
+        raise
+
+    DOWNLOAD_SECONDS.observe(time.time() - start_time)
+    DOWNLOAD_BYTES.inc(download_report["fetched"], source="network")
+    if download_report.get("linked"):
+        DOWNLOADS.inc(result="linked")
+        DOWNLOAD_BYTES.inc(download_report["size"], source="blob_store")
+    else:
+        DOWNLOADS.inc(result="fetched")
+        DOWNLOAD_BYTES.inc(download_report["resumed"], source="resumed")
 
-        if os.path.isfile(local_filename):
-            os.remove(local_filename)
+    return download_report
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def fetch_file(url, local_filename, file_size, file_hash, segments, store_key, store_version):
+    os.makedirs(os.path.dirname(local_filename), exist_ok=True)
 
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment 'if' and set chunk_size parameter to None.
-                #if chunk:
-                f.write(chunk)
+    if store_key is not None:
+        stored_hash = blob_store.find(store_key, store_version, file_hash)
+        if stored_hash is not None and blob_store.link_blob(stored_hash, local_filename):
+            if stored_hash != blob_store.lookup(store_key, store_version):
+                blob_store.add_file(local_filename, key=store_key, version=store_version, file_hash=stored_hash)
+
+            log.info(f"Download skipped, linked from blob store: {os.path.basename(local_filename)}")
+            return {
+                "resumed": 0,
+                "fetched": 0,
+                "size": os.path.getsize(local_filename),
+                "linked": True,
+                "hash": stored_hash
+            }
+    part_filename = local_filename + ".part"
+
+    download_conf = CONFIG.get("download", {})
+    if segments is None:
+        segments = download_conf.get("segments", 1)
+
+    hasher = None
+    if file_hash:
+        hash_type, hash_value = file_hash.split(":", 1)
+        hasher = hashlib.new(hash_type)
+
+    resumed = 0
+    part_meta = {}
+    if os.path.isfile(part_filename):
+        resumed = os.path.getsize(part_filename)
+        part_meta = load_part_meta(part_filename)
+        total_size = file_size if file_size is not None else part_meta.get("size")
+        # without a validator only the file hash can tell that the part is from the same remote file
+        if (total_size is not None and resumed > total_size) or not (part_meta.get("validator") or hasher is not None):
+            remove_part_file(part_filename)
+            resumed = 0
+            part_meta = {}
+    elif os.path.isfile(part_filename + ".json"):
+        os.remove(part_filename + ".json")
+
+    fetched = None
+    if segments > 1 and resumed == 0:
+        fetched = download_segmented(url, part_filename, segments, download_conf.get("min_segment_size", 16 * 1024 * 1024))
+        if fetched is not None and hasher is not None:
+            hasher = None
+            if get_file_hash(part_filename, hash_type).lower() != hash_value.lower():
+                os.remove(part_filename)
+                raise Exception(f"Download checksum mismatch: {os.path.basename(local_filename)} - expected: {hash_value}")
+
+    if fetched is None:
+        fetched = 0
+        msg_headers = {}
+        if resumed > 0:
+            msg_headers["Range"] = f"bytes={resumed}-"
+            if part_meta.get("validator"):
+                # the server sends the whole file (200) when the part is from another version
+                msg_headers["If-Range"] = part_meta["validator"]
+
+        r = http_client.get(url, stream=True, headers=msg_headers)
+        total_size = file_size if file_size is not None else part_meta.get("size")
+        if resumed > 0 and ((r.status_code == 416 and resumed != total_size) or (r.status_code == 206 and not is_same_remote_file(part_meta, r.headers))):
+            r.close()
+            log.warning(f"Part file does not match the remote file. Restarting download: {os.path.basename(local_filename)}")
+            remove_part_file(part_filename)
+            resumed = 0
+            r = http_client.get(url, stream=True)
+
+        with r:
+            if r.status_code == 416 and resumed > 0:
+                # part file is already complete
+                mode = 'ab'
+            else:
+                r.raise_for_status()
+                if resumed > 0 and r.status_code != 206:
+                    log.warning(f"Server did not resume the download (status {r.status_code}). Restarting download: {os.path.basename(local_filename)}")
+                    resumed = 0
+
+                mode = 'ab' if resumed > 0 else 'wb'
+                if resumed == 0:
+                    save_part_meta(part_filename, r.headers)
+
+            if hasher is not None and resumed > 0:
+                with open(part_filename, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+
+            with open(part_filename, mode) as f:
+                if r.status_code != 416:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        fetched += len(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+
+    downloaded_size = os.path.getsize(part_filename)
+    if file_size is not None and downloaded_size != file_size:
+        if downloaded_size > file_size:
+            remove_part_file(part_filename)
+        raise Exception(f"Download size mismatch: {os.path.basename(local_filename)} - expected: {file_size} - received: {downloaded_size}")
+
+    if hasher is not None and hasher.hexdigest().lower() != hash_value.lower():
+        remove_part_file(part_filename)
+        raise Exception(f"Download checksum mismatch: {os.path.basename(local_filename)} - expected: {hash_value} - received: {hasher.hexdigest()}")
+
+    os.replace(part_filename, local_filename)
+    if os.path.isfile(part_filename + ".json"):
+        os.remove(part_filename + ".json")
+
+    log.info(f"Download complete: {os.path.basename(local_filename)} - resumed: {resumed} bytes - fetched: {fetched} bytes")
+
+    if store_key is not None:
+        file_hash = blob_store.add_file(local_filename, key=store_key, version=store_version, file_hash=file_hash)
+
+    return {
+        "resumed": resumed,
+        "fetched": fetched,
+        "size": downloaded_size,
+        "hash": file_hash
+    }
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
-def download_pack(app_token, pack, pack_folder, arch, os_version):
+class HashReader:
+    """
+    File-like wrapper computing the size and hash of the bytes read from a stream
+    """
+    def __init__(self, fileobj, hash_type=None):
+        self.fileobj = fileobj
+        self.hasher = hashlib.new(hash_type) if hash_type else None
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+        return data
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def is_safe_member(member, dest_folder):
+    """
+    Check that a tar member is a regular file, folder or link that stays inside dest_folder
+    """
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        return False
+
+    dest_folder = os.path.realpath(dest_folder)
+    member_path = os.path.realpath(os.path.join(dest_folder, member.name))
+    if os.path.commonpath([dest_folder, member_path]) != dest_folder:
+        return False
+
+    if member.issym():
+        link_path = os.path.realpath(os.path.join(os.path.dirname(member_path), member.linkname))
+        if os.path.commonpath([dest_folder, link_path]) != dest_folder:
+            return False
+    elif member.islnk():
+        link_path = os.path.realpath(os.path.join(dest_folder, member.linkname))
+        if os.path.commonpath([dest_folder, link_path]) != dest_folder:
+            return False
+
+    return True
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def extract_tar(tar, dest_folder):
+    """
+    Extract a tar opened in random access or stream mode, refusing members outside dest_folder
+    """
+    for member in tar:
+        if not is_safe_member(member, dest_folder):
+            raise Exception(f"Unsafe path in archive: {member.name}")
+
+        tar.extract(member, dest_folder)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def merge_folder(src_folder, dest_folder):
+    """
+    Move the content of src_folder into dest_folder, overwriting existing files
+    """
+    for root, dirs, files in os.walk(src_folder):
+        dest_root = os.path.join(dest_folder, os.path.relpath(root, src_folder))
+        os.makedirs(dest_root, exist_ok=True)
+        for filename in files:
+            os.replace(os.path.join(root, filename), os.path.join(dest_root, filename))
+
+    shutil.rmtree(src_folder)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def extract_url(url, dest_folder, file_size=None, file_hash=None, replace=False):
+    """
+    Stream a tar.gz from url straight into a staging folder, verifying size and hash on the fly,
+    then move it to dest_folder. No archive file is written to disk.
+    With replace=True dest_folder is replaced, otherwise the files are merged into it.
+    """
+    dest_folder = os.path.abspath(dest_folder)
+    os.makedirs(os.path.dirname(dest_folder), exist_ok=True)
+    staging_folder = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(dest_folder))
+
+    hash_type, hash_value = file_hash.split(":", 1) if file_hash else (None, None)
+
+    try:
+        with http_client.get(url, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            reader = HashReader(r.raw, hash_type)
+            with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                extract_tar(tar, staging_folder)
+
+            # consume the archive padding so size and hash cover the whole file
+            while reader.read(DOWNLOAD_CHUNK_SIZE):
+                pass
+
+        if file_size is not None and reader.size != file_size:
+            raise Exception(f"Download size mismatch: {url.split('?')[0]} - expected: {file_size} - received: {reader.size}")
+
+        if reader.hasher is not None and reader.hasher.hexdigest().lower() != hash_value.lower():
+            raise Exception(f"Download checksum mismatch: {url.split('?')[0]} - expected: {hash_value} - received: {reader.hasher.hexdigest()}")
+    except:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        raise
+
+    if replace:
+        if os.path.isdir(dest_folder):
+            shutil.rmtree(dest_folder)
+        os.rename(staging_folder, dest_folder)
+    else:
+        merge_folder(staging_folder, dest_folder)
+
+    log.info(f"Stream extract complete: {os.path.basename(dest_folder)} - fetched: {reader.size} bytes")
+
+    return {
+        "resumed": 0,
+        "fetched": reader.size,
+        "size": reader.size
+    }
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def download_extract(url, dest_filename, dest_folder, file_size=None, file_hash=None, store_key=None, store_version=None, replace=False):
+    """
+    Download a tar archive to the blob store (or find it there) and extract it from the blob to dest_folder,
+    removing dest_filename after. With CONFIG["download"]["stream_extract"] an archive not in the store yet
+    is streamed by extract_url instead, without being stored.
+    With replace=True dest_folder is replaced, otherwise the files are merged into it.
+    """
+    if CONFIG.get("download", {}).get("stream_extract", False) and blob_store.find(store_key, store_version, file_hash) is None:
+        return extract_url(url, dest_folder, file_size=file_size, file_hash=file_hash, replace=replace)
+
+    download_report = download_file(url, dest_filename, file_size=file_size, file_hash=file_hash, store_key=store_key, store_version=store_version)
+    if replace and os.path.isdir(dest_folder):
+        shutil.rmtree(dest_folder)
+
+    os.makedirs(dest_folder, exist_ok=True)
+    with tarfile.open(blob_store.get_blob_path(download_report["hash"]), 'r') as tar:
+        extract_tar(tar, dest_folder)
+
+    os.remove(dest_filename)
+    return download_report
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class OutputCapture:
+    """
+    Bounded capture of a process output stream: keeps the head and the tail in memory
+    and spools the whole output to a file in output_folder once it exceeds the memory limit
+    """
+    def __init__(self, name, output_folder, head_size=PROCESS_OUTPUT_HEAD, tail_size=PROCESS_OUTPUT_TAIL):
+        self.name = name
+        self.output_folder = output_folder
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = b""
+        self.tail = collections.deque()
+        self.tail_len = 0
+        self.size = 0
+        self.spool = None
+        self.spool_filename = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.spool is None and self.size > self.head_size + self.tail_size:
+            os.makedirs(self.output_folder, exist_ok=True)
+            fd, self.spool_filename = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".log", dir=self.output_folder)
+            self.spool = os.fdopen(fd, 'wb')
+            self.spool.write(self.head)
+            self.spool.writelines(self.tail)
+
+        if self.spool is not None:
+            self.spool.write(data)
+
+        if len(self.head) < self.head_size:
+            head_part = data[:self.head_size - len(self.head)]
+            self.head += head_part
+            data = data[len(head_part):]
+
+        if data:
+            self.tail.append(data)
+            self.tail_len += len(data)
+            while self.tail_len - len(self.tail[0]) >= self.tail_size:
+                self.tail_len -= len(self.tail.popleft())
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+    def getvalue(self):
+        tail = b"".join(self.tail)
+        if self.spool is None:
+            return (self.head + tail).decode(errors="replace")
+
+        tail = tail[-self.tail_size:]
+        omitted = self.size - len(self.head) - len(tail)
+        return (
+            self.head.decode(errors="replace") +
+            f"\n... [{omitted} bytes omitted - full output: {self.spool_filename}] ...\n" +
+            tail.decode(errors="replace")
+        )
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def purge_process_output(output_folder):
+    """
+    Remove the process output spool files older than CONFIG["tasks"]["output_retention_days"],
+    keeping at most CONFIG["tasks"]["output_max_files"] of the newest
+    """
+    if not os.path.isdir(output_folder):
+        return
+
+    tasks_conf = CONFIG.get("tasks", {})
+    min_mtime = time.time() - tasks_conf.get("output_retention_days", 7) * 24 * 3600
+    max_files = tasks_conf.get("output_max_files", 100)
+
+    spool_files = []
+    for entry in os.scandir(output_folder):
+        if entry.is_file():
+            spool_files.append((entry.stat().st_mtime, entry.path))
+
+    spool_files.sort(reverse=True)
+    for index, (mtime, filename) in enumerate(spool_files):
+        if mtime < min_mtime or index >= max_files:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def run_process(cmd, name="process", cwd=None, timeout=None):
+    """
+    Run a shell command in its own process group, streaming stdout/stderr into bounded captures.
+    On timeout the whole process group is killed. The spool files of the large outputs, referenced
+    in the returned text, are kept by the retention of purge_process_output.
+    Returns (returncode, stdout, stderr)
+    """
+    output_folder = os.path.join(CONFIG["file-service"]["temp_folder"], "process_output")
+    purge_process_output(output_folder)
+    stdout = OutputCapture(f"{name}-stdout", output_folder)
+    stderr = OutputCapture(f"{name}-stderr", output_folder)
+
+    def read_stream(stream, capture):
+        for chunk in iter(lambda: stream.read1(PROCESS_READ_SIZE), b''):
+            capture.write(chunk)
+
+        stream.close()
+        capture.close()
+
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    readers = [
+        threading.Thread(target=read_stream, args=(proc.stdout, stdout), daemon=True),
+        threading.Thread(target=read_stream, args=(proc.stderr, stderr), daemon=True)
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        log.error(f"Process timeout after {timeout}s, killing: {name}")
+        for sig, wait_time in [(signal.SIGTERM, 5), (signal.SIGKILL, None)]:
+            try:
+                os.killpg(proc.pid, sig)
+                proc.wait(timeout=wait_time)
+                break
+            except ProcessLookupError:
+                break
+            except subprocess.TimeoutExpired:
+                continue
+
+    for reader in readers:
+        reader.join(timeout=5)
+
+    stderr_text = stderr.getvalue()
+    if timed_out:
+        stderr_text += f"\nProcess killed after timeout of {timeout}s"
+
+    return proc.returncode, stdout.getvalue(), stderr_text
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+class QueueWriter:
+    """
+    File-like object passing the written bytes to a consumer thread through a bounded queue
+    """
+    def __init__(self, chunk_size=UPLOAD_CHUNK_SIZE, max_chunks=8):
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.stopped = threading.Event()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+        raise Exception("Stream consumer stopped")
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def iter_tar_gz(files):
+    """
+    Generate a tar.gz of files [(filename, arcname)] as it is compressed by a producer thread.
+    Nothing is written to disk.
+    """
+    writer = QueueWriter()
+    end_mark = object()
+
+    def produce():
+        try:
+            with tarfile.open(fileobj=writer, mode="w|gz") as tar:
+                for filename, arcname in files:
+                    tar.add(filename, arcname=arcname)
+
+            writer.close()
+            writer.put(end_mark)
+        except Exception as excp:
+            if not writer.stopped.is_set():
+                writer.put(excp)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = writer.queue.get()
+            if item is end_mark:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        writer.stopped.set()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def iter_multipart(boundary, fields, file_field, filename, content):
+    """
+    Generate a multipart/form-data body with the form fields and one file part streamed from the content iterable
+    """
+    for name, value in fields.items():
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'
+        ).encode()
+
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/gzip\r\n\r\n'
+    ).encode()
+
+    for chunk in content:
+        yield chunk
+
+    yield f'\r\n--{boundary}--\r\n'.encode()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def post_tar_gz(url, files, file_field, filename, fields=None, headers=None):
+    """
+    Compress files [(filename, arcname)] and post them as a multipart file field in one streaming body:
+    compression and transfer overlap and no archive is staged on disk
+    """
+    boundary = uuid.uuid4().hex
+    msg_headers = dict(headers or {})
+    msg_headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+    body = iter_multipart(boundary, fields or {}, file_field, filename, iter_tar_gz(files))
+    try:
+        return http_client.post(url, data=body, headers=msg_headers, retry=False)
+    finally:
+        body.close()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def download_pack(app_token, pack, pack_folder, arch, os_version, extract=False):
+    """
+    Download a pack to pack_folder and return (pack_doc, filename).
+    With extract=True the pack is extracted to pack_folder/<pack_name> and that folder is returned
+    instead of the archive, streaming it from the server when CONFIG["download"]["stream_extract"] is set.
+    """
     try:
         log.info(f'Download pack {pack["name"]}-{arch}')
 
@@ -51,7 +771,7 @@ def download_pack(app_token, pack, pack_folder, arch, os_version):
         url = f'{endpoint}/pack/{pack["id"]}/arch/{arch}/os/{os_version}/?version={pack["version"]}'
         msg_headers = {'Authorization' : f'Bearer {app_token}'}
         payload = {"download_url": True}
-        response = requests.get(url, headers=msg_headers, params=payload, proxies=proxies)
+        response = http_client.get(url, headers=msg_headers, params=payload)
 
         if response.status_code != 200:
             log.error(f'Failing downloading pack {pack["name"]}: {response.json()}')
@@ -59,8 +779,25 @@ def download_pack(app_token, pack, pack_folder, arch, os_version):
 
         pack_doc = response.json()
         dest_filename = os.path.join(folder_path, pack_doc["filename"])
-        download_file(pack_doc["download_url"], dest_filename)
-        return pack_doc, dest_filename
+        file_size, file_hash = get_doc_checksum(pack_doc)
+        store_key = f'pack:{pack["id"]}:{arch}:{os_version}'
+        if not extract:
+            download_file(pack_doc["download_url"], dest_filename, file_size=file_size, file_hash=file_hash, store_key=store_key, store_version=pack_doc["version"])
+            return pack_doc, dest_filename
+
+        dest_folder = os.path.join(folder_path, pack_doc["pack_name"])
+        download_extract(
+            pack_doc["download_url"],
+            dest_filename,
+            dest_folder,
+            file_size=file_size,
+            file_hash=file_hash,
+            store_key=store_key,
+            store_version=pack_doc["version"],
+            replace=True
+        )
+
+        return pack_doc, dest_folder
 
     except requests.ConnectionError as error:
         log.error(f'Failing downloading pack: {pack["name"]}. Connection error: {error}')
@@ -82,7 +819,7 @@ def get_pack(app_token, pack, arch, os_version):
         url = f'{endpoint}/pack/{pack["id"]}/arch/{arch}/os/{os_version}'
         msg_headers = {'Authorization' : f'Bearer {app_token}'}
         payload = {"download_url": False}
-        response = requests.get(url, headers=msg_headers, params=payload, proxies=proxies)
+        response = http_client.get(url, headers=msg_headers, params=payload)
 
         if response.status_code != 200:
             log.error(f'Failing in get pack {pack["name"]}: {response.json()}')
@@ -102,28 +839,34 @@ def get_pack(app_token, pack, arch, os_version):
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
-def install_pack(pack_doc, filename):
+def install_pack(pack_doc, filename, timeout=None):
+    """
+    Run the setup script of a pack. filename is the pack archive or the folder already extracted by download_pack
+    """
     try:
         log.info(f'Installing pack {pack_doc["pack_name"]} - version: {pack_doc["version"]}')
 
-        pack_folder = os.path.join(os.path.dirname(filename), pack_doc["pack_name"])
-        if os.path.isdir(pack_folder):
-            shutil.rmtree(pack_folder)
+        if os.path.isdir(filename):
+            pack_folder = filename
+        else:
+            pack_folder = os.path.join(os.path.dirname(filename), pack_doc["pack_name"])
+            if os.path.isdir(pack_folder):
+                shutil.rmtree(pack_folder)
 
-        with tarfile.open(filename, 'r') as tar:
-            tar.extractall(pack_folder)
+            with tarfile.open(filename, 'r') as tar:
+                extract_tar(tar, pack_folder)
 
         setup_script = os.path.join(pack_folder, "setup.sh")
         if not os.path.isfile(setup_script):
             raise Exception(f"Pack does not have a setup script: {setup_script}")
 
-        ret = subprocess.run(f"cd {pack_folder} && sh setup.sh", capture_output=True, shell=True)
-        # log.info(f"Setup result: {ret.returncode}, {ret.stdout.decode()}, {ret.stderr.decode()}")
-        if ret.returncode != 0:
-            err = f"Pack install fail: {ret.returncode}, {ret.stdout.decode()}, {ret.stderr.decode()}"
+        returncode, stdout, stderr = run_process("sh setup.sh", name=f'install-{pack_doc["pack_name"]}', cwd=pack_folder, timeout=timeout)
+        # log.info(f"Setup result: {returncode}, {stdout}, {stderr}")
+        if returncode != 0:
+            err = f"Pack install fail: {returncode}, {stdout}, {stderr}"
             log.error(err)
 
-        return ret.returncode, ret.stdout.decode(), ret.stderr.decode()
+        return returncode, stdout, stderr
     except Exception as excp:
         err = f'Failing installing pack: {pack_doc["pack_name"]} - {excp}'
         log.error(err)
@@ -131,7 +874,15 @@ def install_pack(pack_doc, filename):
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
-def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
+def get_model_timestamp(model_doc):
+    try:
+        return datetime.datetime.fromisoformat(str(model_doc["date"]).replace("Z", "+00:00")).timestamp()
+    except Exception:
+        return None
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_model(app_token, dataset_id, model_folder, model_type="tensorflow", stats=None):
     local_doc = None
     try:
         # log.info(f"Check model {dataset_id}")
@@ -145,7 +896,7 @@ def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
         url = f"{endpoint}/published-model-v2/{dataset_id}/"
         msg_headers = {'Authorization' : f'Bearer {app_token}'}
         payload = {"download_url": False}
-        response = requests.get(url, headers=msg_headers, params=payload, proxies=proxies)
+        response = http_client.get(url, headers=msg_headers, params=payload)
 
         if response.status_code != 200:
             if local_doc:
@@ -156,10 +907,14 @@ def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
 
         model_doc = response.json()
         if local_doc and model_doc["date"] == local_doc["date"]:
+            model_timestamp = get_model_timestamp(local_doc)
+            if model_timestamp is not None:
+                MODEL_DATE.set(model_timestamp, dataset_id=dataset_id)
+
             return local_doc
 
         payload = {"download_url": True}
-        response = requests.get(url, headers=msg_headers, params=payload, proxies=proxies)
+        response = http_client.get(url, headers=msg_headers, params=payload)
 
         if response.status_code != 200:
             if local_doc:
@@ -179,6 +934,7 @@ def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
                 if model_data.get("type", "") == model_type:
                     download_url = model_data["download_url"]
                     dest_filename = os.path.join(model_folder, model_data["file"])
+                    file_size, file_hash = get_doc_checksum(model_data)
                     break
             else:
                 log.warning(f"Did not find model type {model_type} in {dataset_id} document - {model_doc}")
@@ -190,27 +946,46 @@ def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
             return model_doc
 
         log.info(f"Download model {dataset_id} - Train date: {model_doc['date']}")
-        download_file(download_url, dest_filename)
+        if model_type == "onnx":
+            folder_path = Path(model_folder)
+        else:
+            folder_path = Path(model_folder + '/' + dataset_id)
+
+        if dest_filename.endswith('tar.gz'):
+            download_report = download_extract(
+                download_url,
+                dest_filename,
+                folder_path,
+                file_size=file_size,
+                file_hash=file_hash,
+                store_key=f"model:{dataset_id}:{model_type}",
+                store_version=model_doc["date"]
+            )
+        else:
+            download_report = download_file(
+                download_url,
+                dest_filename,
+                file_size=file_size,
+                file_hash=file_hash,
+                store_key=f"model:{dataset_id}:{model_type}",
+                store_version=model_doc["date"]
+            )
+
+        if stats is not None:
+            stats["bytes"] = download_report["fetched"]
+            stats["updated"] = True
+
+        model_timestamp = get_model_timestamp(model_doc)
+        if model_timestamp is not None:
+            MODEL_DATE.set(model_timestamp, dataset_id=dataset_id)
+            MODEL_UPDATE_LAG.set(max(0, time.time() - model_timestamp), dataset_id=dataset_id)
 
         # expand_file
         if (dest_filename.endswith('tar.gz')):
-            if model_type == "onnx":
-                folder_path = Path(model_folder)
-            else:
-                folder_path = Path(model_folder + '/' + dataset_id)
-
-            if not folder_path.is_dir():
-                folder_path.mkdir(parents=True, exist_ok=True)
-
-            with tarfile.open(dest_filename, 'r') as tar:
-                tar.extractall(folder_path)
-
             trt_file = os.path.join(model_folder, dataset_id + ".trt")
             if os.path.isfile(trt_file):
                 os.remove(trt_file)
 
-            os.remove(dest_filename)
-
         if os.path.isfile(local_cache):
             os.remove(local_cache)
 
@@ -239,84 +1014,379 @@ def get_model(app_token, dataset_id, model_folder, model_type="tensorflow"):
 
 def update_models(app_token, flow_data):
     """
-    Update models for processing flow
+    Update models for processing flow.
+    The datasets are downloaded and extracted by a pool of workers,
+    returns a summary {dataset_id: {"status", "bytes", "elapsed"}}
     """
 
     # log.info(f"Update models for flow")
-    datasets_downloaded = []
     def down_model(dataset_id):
-        if dataset_id in datasets_downloaded or len(dataset_id) != 24:
-            return
-
+        start_time = time.time()
         model_file = os.path.join(model_folder, dataset_id + ".onnx")
         info_file = os.path.join(model_folder, dataset_id + ".json")
         if os.path.isfile(info_file) and not os.path.isfile(model_file):
             os.remove(info_file)
 
-        model_doc = get_model(app_token, dataset_id, model_folder=model_folder, model_type="onnx")
-        datasets_downloaded.append(dataset_id)
+        stats = {"bytes": 0, "updated": False}
+        model_doc = get_model(app_token, dataset_id, model_folder=model_folder, model_type="onnx", stats=stats)
 
-        if "model_list" in model_doc and len(model_doc["model_list"]) == 0:
+        if model_doc is None:
+            status = "fail"
+        elif "model_list" in model_doc and len(model_doc["model_list"]) == 0:
             log.warning(f"Empty model for dataset {dataset_id}")
-            return
+            status = "empty"
+        elif stats["updated"]:
+            status = "updated"
+        else:
+            status = "current"
 
         # if not os.path.isfile(model_file):
         #     raise Exception(f'Model for dataset {dataset_id} not found at: {model_file}')
 
+        MODEL_UPDATES.inc(status=status)
+
+        return {
+            "status": status,
+            "bytes": stats["bytes"],
+            "elapsed": time.time() - start_time
+        }
+
 
     model_folder = CONFIG["file-service"]["model"]
     if not os.path.isdir(model_folder):
         os.makedirs(model_folder, exist_ok=True)
 
+    datasets = set()
     for comp in flow_data["nodes"]:
         if "dataset_id" in comp["options"]:
-            down_model(comp["options"]["dataset_id"])
+            datasets.add(comp["options"]["dataset_id"])
 
         if "classification_dataset_ids" in comp["options"]:
             for output in comp["options"]["classification_dataset_ids"]:
-                down_model(comp["options"]["classification_dataset_ids"][output])
+                datasets.add(comp["options"]["classification_dataset_ids"][output])
+
+    datasets = [dataset_id for dataset_id in datasets if len(dataset_id) == 24]
+
+    summary = {}
+    workers = CONFIG.get("download", {}).get("workers", 4)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(down_model, dataset_id): dataset_id for dataset_id in datasets}
+        for future, dataset_id in futures.items():
+            try:
+                summary[dataset_id] = future.result()
+            except Exception as excp:
+                log.error(f"Fail updating model {dataset_id} - {excp}")
+                summary[dataset_id] = {"status": "fail", "bytes": 0, "elapsed": 0}
+
+    blob_store.gc()
+    return summary
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
-def upload_flow_extracts(app_token, flow_data, max_examples=100):
+class ByteBudget:
+    """
+    Limit the bytes being uploaded at the same time, shared by the upload workers
     """
-    Upload extracts to datasets after processing video
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.limit)
+        with self.cond:
+            self.cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+
+        return size
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_extract_example_keys(names):
+    """
+    Map the extract file names to their example: '<key>_data.json' and the files named '<key>.*' or '<key>_*'.
+    Files of no example are left out.
     """
-    datasets_uploaded = []
+    keys = set(name[:-len("_data.json")] for name in names if name.endswith("_data.json"))
+    example_keys = {}
+    for name in names:
+        # assign the file to the longest example key it starts with
+        for pos in range(len(name) - 1, 0, -1):
+            if name[pos] in "._" and name[:pos] in keys:
+                example_keys[name] = name[:pos]
+                break
+
+    return example_keys
+#----------------------------------------------------------------------------------------------------------------------------------
 
-    def upextract(dataset_id):
-        if dataset_id in datasets_uploaded or len(dataset_id) != 24:
-            return
 
-        extract_path = os.path.join(CONFIG["file-service"]["extract"], dataset_id)
-        files_uploaded = os.listdir(extract_path)
-        if not edge_client.upload_extract(
-            app_token,
-            dataset_id,
-            extract_folder=CONFIG["file-service"]["extract"],
-            max_files=max_examples,
-            thumb_size=128
-        ):
-            log.error(f'Fail uploading extract {dataset_id}')
+def get_extract_examples(extract_path):
+    """
+    Group the files of an extract folder by example.
+    Returns a list of {"key", "files", "bytes", "mtime"} sorted from the oldest example.
+    """
+    entries = {}
+    with os.scandir(extract_path) as it:
+        for entry in it:
+            if entry.is_file():
+                entries[entry.name] = entry.stat()
+
+    examples = {}
+    for name, key in get_extract_example_keys(list(entries)).items():
+        example = examples.setdefault(key, {"key": key, "files": [], "bytes": 0, "mtime": 0})
+        example["files"].append(name)
+        example["bytes"] += entries[name].st_size
+        if name == key + "_data.json":
+            example["mtime"] = entries[name].st_mtime
+
+    return sorted(examples.values(), key=lambda example: example["mtime"])
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_upload_ledger_file(dataset_id):
+    return os.path.join(CONFIG["file-service"]["extract"], f"{dataset_id}.upload_ledger.jsonl")
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def get_upload_batch_file(dataset_id):
+    return os.path.join(CONFIG["file-service"]["extract"], f"{dataset_id}.upload_batch.json")
+#----------------------------------------------------------------------------------------------------------------------------------
+
 
-        log.info("Deleting files from: " + extract_path)
-        for filename in files_uploaded:
+def load_upload_ledger(dataset_id):
+    """
+    (batch_id, filename) of the extract files acknowledged by the server for dataset_id and not deleted yet
+    """
+    ledger_file = get_upload_ledger_file(dataset_id)
+    files_sent = set()
+    if os.path.isfile(ledger_file):
+        with open(ledger_file) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                    files_sent.update((entry["batch_id"], filename) for filename in entry["files"])
+                except Exception:
+                    continue
+
+    return files_sent
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def finish_upload_batch(dataset_id, batch_id):
+    """
+    Drop the ledger entries of a batch whose staged files are all deleted or restored, and its batch file
+    """
+    ledger_file = get_upload_ledger_file(dataset_id)
+    if os.path.isfile(ledger_file):
+        lines = []
+        with open(ledger_file) as fp:
+            for line in fp:
+                try:
+                    if json.loads(line)["batch_id"] != batch_id:
+                        lines.append(line)
+                except Exception:
+                    # entries of the previous format (no batch_id) can not be matched to staged files
+                    continue
+
+        if lines:
+            with open(ledger_file + ".tmp", 'w') as fp:
+                fp.writelines(lines)
+
+            os.replace(ledger_file + ".tmp", ledger_file)
+        else:
+            os.remove(ledger_file)
+
+    batch_file = get_upload_batch_file(dataset_id)
+    if os.path.isfile(batch_file):
+        os.remove(batch_file)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def restore_staged_extracts(dataset_id, extract_path, staging_path):
+    """
+    Recover the files left in staging by an interrupted upload: files of the staged batch recorded in the
+    ledger were sent and are deleted, the others go back to the extract folder
+    """
+    batch_id = None
+    batch_file = get_upload_batch_file(dataset_id)
+    if os.path.isfile(batch_file):
+        try:
+            with open(batch_file) as fp:
+                batch_id = json.load(fp)["batch_id"]
+        except Exception:
+            pass
+
+    if os.path.isdir(staging_path):
+        files_sent = load_upload_ledger(dataset_id)
+        for filename in os.listdir(staging_path):
+            if (batch_id, filename) in files_sent:
+                os.remove(os.path.join(staging_path, filename))
+            else:
+                os.replace(os.path.join(staging_path, filename), os.path.join(extract_path, filename))
+
+    finish_upload_batch(dataset_id, batch_id)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+@contextmanager
+def upload_lock(dataset_id):
+    """
+    Hold the upload of dataset_id between threads and processes, for the whole stage -> upload -> delete sequence
+    """
+    with open(os.path.join(CONFIG["file-service"]["extract"], f"{dataset_id}.upload.lock"), 'w') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fp, fcntl.LOCK_UN)
+#----------------------------------------------------------------------------------------------------------------------------------
+
+
+def upload_dataset_extract(app_token, dataset_id, max_examples=100, examples=None, budget=None):
+    """
+    Upload up to max_examples extract examples of dataset_id (or the given examples).
+    The selected files are moved to a staging folder and uploaded from there, so exactly those files
+    are recorded in the dataset upload ledger, under the batch id, and deleted; the others stay for the next run.
+    Files removed since the examples were listed are skipped. The ledger entry is dropped once the files
+    of the batch are deleted. The dataset is locked by upload_lock until then.
+    """
+    start_time = time.time()
+    extract_path = os.path.join(CONFIG["file-service"]["extract"], dataset_id)
+    staging_folder = os.path.join(CONFIG["file-service"]["extract"], ".uploading")
+    staging_path = os.path.join(staging_folder, dataset_id)
+    result = {"status": "empty", "files": 0, "bytes": 0, "elapsed": 0}
+
+    if not os.path.isdir(extract_path):
+        return result
+
+    with upload_lock(dataset_id):
+        restore_staged_extracts(dataset_id, extract_path, staging_path)
+        if examples is None:
+            examples = get_extract_examples(extract_path)[:max_examples]
+
+        if not examples:
+            return result
+
+        os.makedirs(staging_path, exist_ok=True)
+        # the batch file tells which batch the staged files are from when an upload is interrupted
+        batch_id = uuid.uuid4().hex
+        batch_file = get_upload_batch_file(dataset_id)
+        with open(batch_file + ".tmp", 'w') as fp:
+            json.dump({"batch_id": batch_id, "date": datetime.datetime.now().isoformat()}, fp)
+
+        os.replace(batch_file + ".tmp", batch_file)
+        files = []
+        upload_bytes = 0
+        staged_examples = 0
+        for example in examples:
+            example_files = 0
+            for filename in example["files"]:
+                try:
+                    os.replace(os.path.join(extract_path, filename), os.path.join(staging_path, filename))
+                except FileNotFoundError:
+                    continue
+
+                files.append(filename)
+                upload_bytes += os.path.getsize(os.path.join(staging_path, filename))
+                example_files += 1
+
+            if example_files:
+                staged_examples += 1
+
+        if not files:
+            finish_upload_batch(dataset_id, batch_id)
             try:
-                os.remove(os.path.join(extract_path, filename))
-            except:
+                os.rmdir(staging_path)
+            except OSError:
                 pass
 
-        datasets_uploaded.append(dataset_id)
+            return result
+
+        reserved = budget.acquire(upload_bytes) if budget is not None else 0
+        try:
+            uploaded = edge_client.upload_extract(
+                app_token,
+                dataset_id,
+                extract_folder=staging_folder,
+                max_files=staged_examples,
+                thumb_size=128
+            )
+        except Exception as excp:
+            log.error(f'Fail uploading extract {dataset_id} - {excp}')
+            uploaded = False
+        finally:
+            if budget is not None:
+                budget.release(reserved)
+
+        if not uploaded:
+            log.error(f'Fail uploading extract {dataset_id}')
+            restore_staged_extracts(dataset_id, extract_path, staging_path)
+            result["status"] = "fail"
+        else:
+            with open(get_upload_ledger_file(dataset_id), 'a') as fp:
+                fp.write(json.dumps({"batch_id": batch_id, "date": datetime.datetime.now().isoformat(), "files": files, "bytes": upload_bytes}) + "\n")
+
+            log.info(f"Deleting {len(files)} uploaded files from: {extract_path}")
+            for filename in files:
+                try:
+                    os.remove(os.path.join(staging_path, filename))
+                except Exception:
+                    pass
+
+            finish_upload_batch(dataset_id, batch_id)
+            result.update({"status": "success", "files": len(files), "bytes": upload_bytes})
+
+        try:
+            os.rmdir(staging_path)
+        except OSError:
+            pass
+
+    result["elapsed"] = time.time() - start_time
+    return result
+#----------------------------------------------------------------------------------------------------------------------------------
+
 
+def upload_flow_extracts(app_token, flow_data, max_examples=100):
+    """
+    Upload extracts to datasets after processing video.
+    Datasets are uploaded concurrently, limited by CONFIG["upload"]["workers"] and
+    by the bytes in flight (CONFIG["upload"]["max_inflight_mb"])
+    """
     log.info(f"Upload extracts for flow")
 
+    datasets = set()
     for comp in flow_data["nodes"]:
-        if "dataset_id" in comp["options"] and comp["options"]["dataset_id"] not in datasets_uploaded:
-            upextract(comp["options"]["dataset_id"])
+        if "dataset_id" in comp["options"]:
+            datasets.add(comp["options"]["dataset_id"])
 
         if "classification_dataset_ids" in comp["options"]:
             for output in comp["options"]["classification_dataset_ids"]:
-                upextract(comp["options"]["classification_dataset_ids"][output])
+                datasets.add(comp["options"]["classification_dataset_ids"][output])
+
+    datasets = [dataset_id for dataset_id in datasets if len(dataset_id) == 24]
+
+    upload_conf = CONFIG.get("upload", {})
+    budget = ByteBudget(upload_conf.get("max_inflight_mb", 64) * 1024 * 1024)
+    with ThreadPoolExecutor(max_workers=max(1, upload_conf.get("workers", 4))) as executor:
+        futures = {dataset_id: executor.submit(upload_dataset_extract, app_token, dataset_id, max_examples, budget=budget) for dataset_id in datasets}
+        summary = {dataset_id: futures[dataset_id].result() for dataset_id in futures}
+
+    for dataset_id, result in summary.items():
+        if result["status"] == "empty":
+            continue
+
+        elapsed = max(result["elapsed"], 0.001)
+        log.info(
+            f'Extract {dataset_id}: {result["status"]} - {result["files"]} files - {result["bytes"]} bytes - '
+            f'{result["files"] / elapsed:.1f} files/s - {result["bytes"] / elapsed / (1024 * 1024):.2f} MB/s'
+        )
+
+    return summary
 #----------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -454,7 +1524,7 @@ def get_edge_data(app_token):
         log.info(f"Get edge_data")
         endpoint = jwt.decode(app_token, options={"verify_signature": False})['endpoint']
         msg_headers = {'Authorization' : f'Bearer {app_token}'}
-        response = requests.get(f"{endpoint}", headers=msg_headers, proxies=proxies)
+        response = http_client.get(f"{endpoint}", headers=msg_headers)
 
         if response.status_code != 200:
             log.error(f"Failing get edge_data: {response.json()}")